@@ -1,9 +1,14 @@
 import sys
-import copy
 import logging
 import uuid
+from functools import wraps
+from inspect import signature
+from io import BytesIO
+from time import monotonic
 from trelliopg.sql import async_atomic
+from trelliolibs.db.snapshot import TreeSnapshot
 from trelliolibs.utils.helpers import RecordHelper, uuid_serializer
+from trelliolibs.utils.loaders import SingleFlight
 from collections import deque
 
 
@@ -51,13 +56,152 @@ class Stack:
 
 logger = logging.getLogger(__name__)
 
+
+def from_snapshot(lookup, node=None):
+    """
+    answers a read from the snapshot of the tree when the manager keeps snapshots, lookup(snapshot, arguments) gets the
+    arguments of the call by name and raises KeyError for nodes the snapshot does not hold, the method queries then
+    :param str node: argument holding the node id, or a list of them, a loaded snapshot holding every one of them is
+                     used when no group is given
+    """
+
+    def decorator(method):
+        method_signature = signature(method)
+
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            # calls inside a transaction see its writes, the snapshot does not
+            if self.snapshots and 'conn' not in kwargs:
+                arguments = method_signature.bind(self, *args, **kwargs)
+                arguments.apply_defaults()
+                arguments = arguments.arguments
+                snapshot = await self._find_snapshot(arguments.get('group_id', ''), arguments.get(node))
+                if snapshot is not None:
+                    try:
+                        return lookup(snapshot, arguments)
+                    except KeyError:
+                        pass
+            return await method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def invalidates_snapshots(method):
+    """
+    drops the snapshots of the manager before and after a write, the second time once its transaction is over, and
+    tells the other processes through the invalidator of the manager
+    """
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        self._invalidate_snapshots()
+        try:
+            result = await method(self, *args, **kwargs)
+            if self.invalidator is not None:
+                # inside the transaction of a caller the notification is only delivered on its commit
+                await self.invalidator.publish(self.table_name, con=kwargs.get('conn'))
+            return result
+        finally:
+            self._invalidate_snapshots()
+
+    return wrapper
+
+
 class NestedCategoriesManager:
-    def __init__(self, table_name, left_col_name, right_col_name, group_name, parent_name):
+    def __init__(self, table_name, left_col_name, right_col_name, group_name, parent_name, slow_log=None,
+                 snapshots=False, snapshot_ttl=None, invalidator=None):
+        """
+        :param bool snapshots: keep the tree of each group in memory and answer node, children and leaves lookups from
+                               it, the snapshots are dropped by the writes of this manager
+        :param float snapshot_ttl: seconds a snapshot is kept, bounds how long writes of other processes go unseen
+        :param CacheInvalidator invalidator: publishes the writes of this manager with NOTIFY and drops the snapshots
+                                             on the writes of other processes
+        """
         self.table_name = table_name
         self.left_name = left_col_name
         self.right_name = right_col_name
         self.group_name = group_name
         self.parent_name = parent_name
+        self.slow_log = slow_log
+        self.snapshots = snapshots
+        self.snapshot_ttl = snapshot_ttl
+        self.invalidator = invalidator
+        self._snapshots = dict()  # group -> TreeSnapshot, None when the rows are not a single tree
+        self._loaded = dict()  # group -> load time of its snapshot
+        self._snapshot_flight = SingleFlight()
+        self._generation = 0
+        self._column_types = None
+        if invalidator is not None:
+            invalidator.register(table_name, self)
+
+    async def snapshot(self, group_id=''):
+        """
+        :return: the tree of group_id held in memory, loaded on first use, None when its rows do not form a single tree
+        """
+        if self.invalidator is not None:
+            await self.invalidator.listen()
+        if group_id in self._snapshots and not self._expired(group_id):
+            return self._snapshots[group_id]
+        return await self._snapshot_flight.do(group_id, lambda: self._load_snapshot(group_id))
+
+    def snapshot_memory(self) -> dict:
+        """
+        :return: approximate bytes held by the snapshot of each group
+        """
+        return dict((group_id, snapshot.memory_size()) for group_id, snapshot in self._snapshots.items()
+                    if snapshot is not None)
+
+    def invalidate(self, table, where=None, records=()):
+        """
+        called by the invalidator on a write of the table, the affected groups are not known so every snapshot goes
+        """
+        self._invalidate_snapshots()
+
+    def clear(self):
+        self._invalidate_snapshots()
+
+    async def _load_snapshot(self, group_id):
+        generation = self._generation
+        rows = await NestedCategoriesManager.get_all(self, group_id)
+        snapshot = None
+        # a table holding the trees of several groups can not be looked up by bounds without its group
+        if sum(1 for row in rows if not row[self.parent_name]) <= 1:
+            snapshot = TreeSnapshot(rows, self.left_name, self.right_name, self.parent_name)
+        if generation == self._generation:  # a write ended while loading, the rows may be older than it
+            self._snapshots[group_id] = snapshot
+            self._loaded[group_id] = monotonic()
+        return snapshot
+
+    async def _find_snapshot(self, group_id='', node_id=None):
+        if node_id is not None and not group_id:
+            # loading the whole table to find the group of a node costs more than querying the node
+            node_ids = node_id if isinstance(node_id, (list, tuple, set)) else [node_id]
+            for loaded_group, snapshot in list(self._snapshots.items()):
+                if snapshot is not None and all(node_id in snapshot for node_id in node_ids) and \
+                        not self._expired(loaded_group):
+                    return snapshot
+            return None
+        return await self.snapshot(group_id)
+
+    def _expired(self, group_id):
+        return self.snapshot_ttl is not None and self._loaded.get(group_id, 0) + self.snapshot_ttl < monotonic()
+
+    def _invalidate_snapshots(self):
+        self._generation += 1
+        self._snapshots.clear()
+        self._loaded.clear()
+
+    async def _fetch(self, conn, query, *args):
+        if self.slow_log is None:
+            return await conn.fetch(query, *args)
+        return await self.slow_log.run(conn.fetch, query, *args)
+
+    async def _execute(self, conn, query, *args):
+        if self.slow_log is None:
+            return await conn.execute(query, *args)
+        return await self.slow_log.run(conn.execute, query, *args)
 
     @async_atomic(raise_exception=True)
     async def filter_by_params(self, params, group_id='', **kwargs):
@@ -66,10 +210,10 @@ class NestedCategoriesManager:
             params[self.group_name] = group_id
         where_str = 'where '+' and '.join(["{col}='{val}'".format(col=col, val=val) for col, val in params.items()])
         q_s = 'SELECT * FROM {table} {where};'.format(where=where_str,table=self.table_name)
-        logger.info(q_s)
-        result = await conn.fetch(q_s)
+        result = await self._fetch(conn, q_s)
         return RecordHelper.record_to_dict(result, normalize=[uuid_serializer])
 
+    @from_snapshot(lambda snapshot, arguments: snapshot.leaves())
     @async_atomic(raise_exception=True)
     async def get_leaves(self, group_id='', **kwargs):
         conn = kwargs['conn']
@@ -80,8 +224,7 @@ class NestedCategoriesManager:
             query_dict['only_group'] = " and %s='%s' " % (self.group_name, group_id)
         else:
             query_dict['only_group'] = ''
-        logger.info(query_str.format(**query_dict))
-        result = await conn.fetch(query_str.format(**query_dict))
+        result = await self._fetch(conn, query_str.format(**query_dict))
         if result:
             return RecordHelper.record_to_dict(result, normalize=[uuid_serializer])
         else:
@@ -97,26 +240,28 @@ class NestedCategoriesManager:
             group_only = ''
         formatted_qs = query_str.format(table_name=self.table_name, limit=limit,
                                                     left_col=self.left_name, group_only=group_only)
-        logger.info(formatted_qs)
-        records = await conn.fetch(formatted_qs)
+        records = await self._fetch(conn, formatted_qs)
         if records:
             return RecordHelper.record_to_dict(records, normalize=[uuid_serializer])
         else:
             return []
 
+    @from_snapshot(lambda snapshot, arguments: snapshot.has_children(arguments['node_id']),
+               node='node_id')
     @async_atomic(raise_exception=True)
     async def has_children(self, node_id, **kwargs):  # node_id unique group_id not needed
         conn = kwargs['conn']
         query_str = '''
 		SELECT * FROM {table_name} WHERE {parent_name}='{parent_id}' LIMIT 1;
 		'''
-        logger.info(query_str.format(table_name=self.table_name, parent_name=self.parent_name, parent_id=str(node_id)))
-        result = await conn.fetch(
-            query_str.format(table_name=self.table_name, parent_name=self.parent_name, parent_id=str(node_id)))
+        result = await self._fetch(
+            conn, query_str.format(table_name=self.table_name, parent_name=self.parent_name, parent_id=str(node_id)))
         if result:
             return True
         return False
 
+    @from_snapshot(lambda snapshot, arguments: snapshot.children(arguments['parent_id']),
+               node='parent_id')
     @async_atomic(raise_exception=True)
     async def get_children_by_id(self, parent_id, **kwargs):  # parent_id unique group_id not needed
         conn = kwargs['conn']
@@ -127,13 +272,14 @@ class NestedCategoriesManager:
         query_dict = {'left_col': self.left_name, 'parent_value': str(parent_id),
                       'table_name': self.table_name, 'parent_name': self.parent_name
                       }
-        logger.info(query_str.format(**query_dict))
-        result = await conn.fetch(query_str.format(**query_dict))
+        result = await self._fetch(conn, query_str.format(**query_dict))
         if result:
             return RecordHelper.record_to_dict(result, normalize=[uuid_serializer])
         else:
             return []
 
+    @from_snapshot(lambda snapshot, arguments: (snapshot.descendants if arguments['all'] else snapshot.children)(
+        arguments['parent_id']), node='parent_id')
     @async_atomic(raise_exception=True)
     async def get_children(self, parent_id, all=True, group_id='', **kwargs):
         conn = kwargs['conn']
@@ -144,7 +290,7 @@ class NestedCategoriesManager:
         query_dict = {'left_col': self.left_name, 'right_col': self.right_name,
                       'table_name': self.table_name
                       }
-        parent_node = await self.get_node(parent_id, conn=conn)
+        parent_node = (await self.get_node(parent_id, conn=conn))[0]
         left_val = parent_node[self.left_name]
         right_val = parent_node[self.right_name]
         query_dict['left_val'] = left_val
@@ -157,13 +303,13 @@ class NestedCategoriesManager:
             query_dict['group_query'] = " and %s='%s' " % (self.group_name, group_id)
         else:
             query_dict['group_query'] = ''
-        logger.info(query_str.format(**query_dict))
-        result = await conn.fetch(query_str.format(**query_dict))
+        result = await self._fetch(conn, query_str.format(**query_dict))
         if result:
             return RecordHelper.record_to_dict(result, normalize=[uuid_serializer])
         else:
             return []
 
+    @from_snapshot(lambda snapshot, arguments: [snapshot.node(arguments['id'])], node='id')
     @async_atomic(raise_exception=True)
     async def get_node(self, id, **kwargs):  # id is unique group_id is not needed
         conn = kwargs['conn']
@@ -172,12 +318,70 @@ class NestedCategoriesManager:
 		'''
         query_dict = {'table_name': self.table_name, 'where_str': ''}
         query_dict['where_str'] = "id='%s'" % (str(id))
-        logger.info(query_str.format(**query_dict))
-        result = await conn.fetch(query_str.format(**query_dict))
+        result = await self._fetch(conn, query_str.format(**query_dict))
         if not result:
             raise RowNotFound
         return RecordHelper.record_to_dict(result, normalize=[uuid_serializer])
 
+    @from_snapshot(lambda snapshot, arguments: snapshot.ancestors(arguments['node_id']), node='node_id')
+    @async_atomic(raise_exception=True)
+    async def get_ancestors(self, node_id, **kwargs):  # node_id unique group_id not needed
+        """
+        :return: the nodes whose bounds enclose the node, from the root down
+        """
+        conn = kwargs['conn']
+        where = 'n.id={}'.format(await self._param(conn, 'id', 1))
+        result = await self._fetch(conn, self._ancestors_query(where), str(node_id))
+        return RecordHelper.record_to_dict(result, normalize=[uuid_serializer])
+
+    @from_snapshot(lambda snapshot, arguments: len(snapshot.ancestors(arguments['node_id'])), node='node_id')
+    @async_atomic(raise_exception=True)
+    async def get_depth(self, node_id, **kwargs):  # node_id unique group_id not needed
+        """
+        :return: number of ancestors of the node, 0 for the root
+        """
+        conn = kwargs['conn']
+        where = 'n.id={}'.format(await self._param(conn, 'id', 1))
+        query_str = self._ancestors_query(where, columns='count(a.id) AS depth', order=False)
+        return (await self._fetch(conn, query_str, str(node_id)))[0]['depth']
+
+    def get_subtree_size(self, node_dict):
+        """
+        :return: number of descendants of the node, from its bounds alone
+        """
+        return (node_dict[self.right_name] - node_dict[self.left_name] - 1) // 2
+
+    @from_snapshot(lambda snapshot, arguments: dict((str(node_id), snapshot.ancestors(node_id))
+                                                    for node_id in arguments['ids']), node='ids')
+    @async_atomic(raise_exception=True)
+    async def get_ancestors_many(self, ids, group_id='', **kwargs):
+        """
+        ancestors of many nodes with a single query, for breadcrumbs of a list of nodes
+        :return: id to the ancestors of the node from the root down, empty for roots and unknown ids
+        """
+        conn = kwargs['conn']
+        ids = [str(node_id) for node_id in ids]
+        where, args = 'n.id = any({})'.format(await self._param(conn, 'id', 1, array=True)), [ids]
+        if group_id:
+            where = where + ' AND n.{}={}'.format(self.group_name, await self._param(conn, self.group_name, 2))
+            args = [ids, str(group_id)]
+        query_str = self._ancestors_query(where, columns='n.id AS descendant_id, a.*')
+        ancestors = dict((node_id, []) for node_id in ids)
+        for record in await self._fetch(conn, query_str, *args):
+            node = RecordHelper.record_to_dict(record, normalize=[uuid_serializer])
+            ancestors[str(node.pop('descendant_id'))].append(node)
+        return ancestors
+
+    def _ancestors_query(self, where, columns='a.*', order=True):
+        # the ancestors of n are the nodes of its tree enclosing its bounds, one range condition on a self join
+        query_str = '''SELECT {columns} FROM {table_name} n JOIN {table_name} a
+                      ON a.{left_col}<n.{left_col} AND a.{right_col}>n.{right_col}
+                      AND a.{group_col} IS NOT DISTINCT FROM n.{group_col}
+                      WHERE {where}{order};'''
+        return query_str.format(columns=columns, table_name=self.table_name, left_col=self.left_name,
+                                right_col=self.right_name, group_col=self.group_name, where=where,
+                                order=' ORDER BY a.{}'.format(self.left_name) if order else '')
+
     @async_atomic(raise_exception=True)
     async def get_forward_siblings(self, node_dict, group_id='', **kwargs):
         conn = kwargs['conn']
@@ -187,86 +391,337 @@ class NestedCategoriesManager:
 		'''
         query_dict = {'table_name': self.table_name, 'parent_value': node_dict[self.parent_name], 'left_col': self.left_name,
                       'right_val': node_dict[self.right_name], 'id': node_dict['id'], 'parent_name': self.parent_name}
-        logger.info(query_str.format(**query_dict))
-        result = await conn.fetch(query_str.format(**query_dict))
+        result = await self._fetch(conn, query_str.format(**query_dict))
         if result:
             return RecordHelper.record_to_dict(result, normalize=[uuid_serializer])
         else:
             return []
 
+    @invalidates_snapshots
     @async_atomic(raise_exception=True)
-    async def insert(self, node_dict, **kwargs):  # modified dfs
+    async def insert(self, node_dict, **kwargs):
+        # the new node becomes the last child of its parent: every bound at or right of the parent's right bound
+        # moves by 2 and the node takes the gap, a fixed number of statements whatever the size of the tree
+        # every statement runs on conn, async_atomic does not hand a pooled connection on to the decorated methods
         conn = kwargs['conn']
         if not node_dict[self.parent_name]:
-            group_nodes = await self.get_all(limit=1, group_id=node_dict.get(self.group_name, ''), conn=conn)
-            if group_nodes:
+            group_id = node_dict.get(self.group_name, '')
+            await self._lock_tree(conn, group_id)
+            group_query, group_args = await self._in_group(conn, group_id, 1)
+            roots = await self._fetch(conn, 'SELECT id FROM {table_name} WHERE {parent_name} IS NULL{group_query} '
+                                            'LIMIT 1;'.format(table_name=self.table_name, parent_name=self.parent_name,
+                                                              group_query=group_query), *group_args)
+            if roots:
                 raise NodeParentMissing
             else:
                 node_dict[self.left_name] = 1
                 node_dict[self.right_name] = 2
                 del node_dict[self.parent_name]
-                print(node_dict, 'node dict')
-                new_node = await self._create_node(node_dict, conn=conn)
+                new_node = await self._insert_node(conn, node_dict)
                 return new_node
-        parent_node = await self.get_node(node_dict[self.parent_name], conn=conn)
-        cur_value = parent_node[self.right_name]
-        node_dict[self.left_name] = copy.deepcopy(cur_value)
-        node_dict[self.right_name] = copy.deepcopy(cur_value + 1)
-        cur_value += 1
-        if parent_node[self.parent_name]:
-            parent_siblings = await self.get_forward_siblings(parent_node, group_id=parent_node.get(self.group_name), conn=conn)
-            if parent_siblings and type(parent_siblings) != list:
-                parent_siblings = [parent_siblings]
+
+        # the node joins the tree of its parent, which gives the group to lock and renumber
+        parent = await self._lock_node(conn, node_dict[self.parent_name], node_dict.get(self.group_name))
+        group_id, parent_right = parent[self.group_name], parent[self.right_name]
+        node_dict[self.group_name] = group_id
+
+        group_query, group_args = await self._in_group(conn, group_id, 2)
+        await self._execute(conn, 'UPDATE {table_name} SET {right_col}={right_col}+2 WHERE {right_col}>=$1{group_query};'
+                            .format(table_name=self.table_name, right_col=self.right_name, group_query=group_query),
+                            parent_right, *group_args)
+        await self._execute(conn, 'UPDATE {table_name} SET {left_col}={left_col}+2 WHERE {left_col}>$1{group_query};'
+                            .format(table_name=self.table_name, left_col=self.left_name, group_query=group_query),
+                            parent_right, *group_args)
+
+        node_dict[self.left_name] = parent_right
+        node_dict[self.right_name] = parent_right + 1
+        new_node = await self._insert_node(conn, node_dict)
+        return new_node
+
+    @invalidates_snapshots
+    @async_atomic(raise_exception=True)
+    async def move_subtree(self, node_id, new_parent_id, position=None, group_id='', **kwargs):
+        """
+        :param position: index of the node among the children of its new parent, the last child when None
+        """
+        # the subtree keeps its width and moves as a block, the bounds between its old and new place shift the other
+        # way by that width, a single UPDATE over the range between the two places
+        conn = kwargs['conn']
+        node = await self._lock_node(conn, node_id, group_id)
+        parent = await self._get_bounds(conn, new_parent_id)
+        left, right = node[self.left_name], node[self.right_name]
+        if parent[self.group_name] != node[self.group_name]:
+            raise InvalidArgument("%s of the new parent differs" % self.group_name)
+        if left <= parent[self.left_name] <= right:
+            raise InvalidArgument("a node can not be moved under itself")
+
+        target = parent[self.right_name]
+        if position is not None:
+            siblings = await self._fetch(
+                conn, 'SELECT {left_col} FROM {table_name} WHERE {parent_name}={parent} AND id!={id} '
+                      'ORDER BY {left_col} OFFSET $3 LIMIT 1;'.format(
+                    left_col=self.left_name, table_name=self.table_name, parent_name=self.parent_name,
+                    parent=await self._param(conn, self.parent_name, 1), id=await self._param(conn, 'id', 2)),
+                str(new_parent_id), str(node_id), int(position))
+            if siblings:
+                target = siblings[0][self.left_name]
+
+        width = right - left + 1
+        if target > right:
+            low, high, shift, distance = right + 1, target - 1, -width, target - 1 - right
         else:
-            parent_siblings = []
-        dfs_stack = Stack()
-        for i in parent_siblings:
-            dfs_stack.push((True, i, True))
-        dfs_stack.push((False, parent_node, True))
-
-        while not dfs_stack.is_empty():  # updating lt,rt entries
-            el = dfs_stack.pop()
-            if not el[0]:
-                cur_value += 1
-                node = el[1]
-                node[self.right_name] = cur_value
-                await self._update_node(node['id'], {self.right_name: node[self.right_name],
-                                                     self.group_name:node.get(self.group_name, '')}, conn=conn)
+            low, high, shift, distance = target, left - 1, width, target - left
+
+        group_query, group_args = await self._in_group(conn, node[self.group_name], 11)
+        query_str = '''UPDATE {table_name} SET
+            {left_col}=CASE WHEN {left_col} BETWEEN $1 AND $2 THEN {left_col}+$3
+                            WHEN {left_col} BETWEEN $4 AND $5 THEN {left_col}+$6 ELSE {left_col} END,
+            {right_col}=CASE WHEN {right_col} BETWEEN $1 AND $2 THEN {right_col}+$3
+                             WHEN {right_col} BETWEEN $4 AND $5 THEN {right_col}+$6 ELSE {right_col} END,
+            {parent_name}=CASE WHEN id={id} THEN {parent} ELSE {parent_name} END
+            WHERE ({left_col} BETWEEN $9 AND $10 OR {right_col} BETWEEN $9 AND $10){group_query};'''
+        await self._execute(conn, query_str.format(table_name=self.table_name, left_col=self.left_name,
+                                                   right_col=self.right_name, parent_name=self.parent_name,
+                                                   id=await self._param(conn, 'id', 7),
+                                                   parent=await self._param(conn, self.parent_name, 8),
+                                                   group_query=group_query),
+                            left, right, distance, low, high, shift, str(node_id), str(new_parent_id),
+                            min(left, low), max(right, high), *group_args)
+        # read on conn, the move is not committed yet
+        return await self._select_node(conn, node_id)
+
+    @invalidates_snapshots
+    @async_atomic(raise_exception=True)
+    async def delete_subtree(self, node_id, group_id='', **kwargs):
+        """
+        deletes the node and all of its descendants
+        :return: the deleted rows
+        """
+        conn = kwargs['conn']
+        node = await self._lock_node(conn, node_id, group_id)
+        left, right = node[self.left_name], node[self.right_name]
+        group_query, group_args = await self._in_group(conn, node[self.group_name], 3)
+
+        deleted = await self._fetch(conn, 'DELETE FROM {table_name} WHERE {left_col} BETWEEN $1 AND $2{group_query} '
+                                          'RETURNING *;'.format(table_name=self.table_name, left_col=self.left_name,
+                                                                group_query=group_query),
+                                    left, right, *group_args)
+        width = right - left + 1
+        for col in (self.right_name, self.left_name):
+            await self._execute(conn, 'UPDATE {table_name} SET {col}={col}-$1 WHERE {col}>$2{group_query};'.format(
+                table_name=self.table_name, col=col, group_query=group_query), width, right, *group_args)
+        return RecordHelper.record_to_dict(deleted, normalize=[uuid_serializer])
+
+    @invalidates_snapshots
+    @async_atomic(raise_exception=True)
+    async def bulk_load(self, nodes, group_id='', **kwargs):
+        """
+        adds many nodes to the tree of group_id at once, parents may be nodes of the tree or other nodes of the list
+        and come in any order, children keep the order of the list after the existing ones
+        :param list nodes: node dicts as taken by insert, ids are generated for the ones without one
+        :return: number of nodes in the tree
+        """
+        conn = kwargs['conn']
+        if not nodes:
+            return 0
+        await self._lock_tree(conn, group_id)
+        nodes = [dict(node) for node in nodes]
+        new_ids = iter(await self._new_ids(conn, sum(1 for node in nodes if 'id' not in node)))
+        for node in nodes:
+            if 'id' not in node:
+                node['id'] = next(new_ids)
+            node[self.parent_name] = node.get(self.parent_name) or None
+            if group_id:
+                node[self.group_name] = group_id
+
+        pairs = await self._get_pairs(conn, group_id)
+        pairs.extend((str(node['id']), node.get(self.parent_name)) for node in nodes)
+        bounds = self._number(pairs)
+        await self._write_bounds(conn, bounds, exclude=set(str(node['id']) for node in nodes))
+
+        columns = [self.left_name, self.right_name]
+        for node in nodes:
+            for column in node:
+                if column not in columns:
+                    columns.append(column)
+        rows = []
+        for node in nodes:
+            node[self.left_name], node[self.right_name] = bounds[str(node['id'])]
+            rows.append([node.get(column) for column in columns])
+        await conn.copy_to_table(self.table_name, source=self._copy_source(rows), columns=columns)
+        return len(bounds)
+
+    @invalidates_snapshots
+    @async_atomic(raise_exception=True)
+    async def rebuild(self, group_id='', **kwargs):
+        """
+        numbers the tree of group_id again from the parent of its nodes, also repairs trees left with wrong bounds
+        :return: number of nodes in the tree
+        """
+        conn = kwargs['conn']
+        await self._lock_tree(conn, group_id)
+        bounds = self._number(await self._get_pairs(conn, group_id))
+        await self._write_bounds(conn, bounds)
+        return len(bounds)
+
+    async def _get_pairs(self, conn, group_id=''):
+        # ordering on the current bounds keeps the order of siblings, nodes without bounds go last
+        query_str = 'SELECT id, {parent_name} FROM {table_name}{group_query} ORDER BY {left_col} NULLS LAST, id;'
+        group_query, group_args = '', []
+        if group_id:
+            group_query = ' WHERE {}={}'.format(self.group_name, await self._param(conn, self.group_name, 1))
+            group_args = [str(group_id)]
+        records = await self._fetch(conn, query_str.format(parent_name=self.parent_name, table_name=self.table_name,
+                                                           group_query=group_query, left_col=self.left_name),
+                                    *group_args)
+        return [(str(record['id']), record[self.parent_name]) for record in records]
+
+    def _number(self, pairs):
+        """
+        :param list pairs: (id, parent id) of every node of a tree, siblings in order
+        :return: id to (left, right), numbered by a depth first walk from the root
+        """
+        children = dict()
+        roots = []
+        for node_id, parent_id in pairs:
+            if parent_id:
+                children.setdefault(str(parent_id), []).append(node_id)
+            else:
+                roots.append(node_id)
+        if not pairs:
+            return dict()
+        if len(roots) != 1 or not children.keys() <= set(node_id for node_id, _ in pairs):
+            raise NodeParentMissing
+
+        bounds = dict()
+        counter = 1
+        stack = Stack()
+        stack.push((roots[0], False))
+        while not stack.is_empty():
+            node_id, visited = stack.pop()
+            if visited:
+                bounds[node_id] = (bounds[node_id], counter)
             else:
-                node = el[1]
-                cur_value += 1
-                node[self.left_name] = cur_value
-                if await self.has_children(node['id'], conn=conn):
-                    dfs_stack.push((False, node, True))
-                    children = await self.get_children_by_id(node['id'], conn=conn)  # direct children
-                    if children and type(children) != list:
-                        children = [children]
-                    for i in children:
-                        dfs_stack.push((True, i, True))
+                bounds[node_id] = counter
+                stack.push((node_id, True))
+                for child_id in reversed(children.get(node_id, ())):
+                    stack.push((child_id, False))
+            counter += 1
+        if len(bounds) != len(pairs):
+            raise InvalidNodeDict('parents of the nodes form a cycle')
+        return bounds
+
+    async def _write_bounds(self, conn, bounds, exclude=()):
+        # COPY into a temporary table and one UPDATE joining it, whatever the number of nodes
+        rows = [(node_id, left, right) for node_id, (left, right) in bounds.items() if node_id not in exclude]
+        if not rows:
+            return
+        temp_table = '{}_bounds'.format(self.table_name)
+        await self._execute(conn, 'CREATE TEMPORARY TABLE {temp_table} AS '
+                                  'SELECT id, {left_col}, {right_col} FROM {table_name} WITH NO DATA;'.format(
+            temp_table=temp_table, left_col=self.left_name, right_col=self.right_name, table_name=self.table_name))
+        await conn.copy_to_table(temp_table, source=self._copy_source(rows))
+        await self._execute(conn, 'UPDATE {table_name} SET {left_col}=b.{left_col}, {right_col}=b.{right_col} '
+                                  'FROM {temp_table} b WHERE {table_name}.id=b.id;'.format(
+            table_name=self.table_name, left_col=self.left_name, right_col=self.right_name, temp_table=temp_table))
+        await self._execute(conn, 'DROP TABLE {};'.format(temp_table))
+
+    @staticmethod
+    def _copy_source(rows):
+        # COPY text format, values are sent as text and converted to the column types by postgres
+        lines = []
+        for row in rows:
+            values = []
+            for value in row:
+                if value is None:
+                    values.append('\\N')
                 else:
-                    cur_value += 1
-                    node[self.right_name] = cur_value
-                await self._update_node(node['id'], {self.right_name: node[self.right_name],
-                                                     self.left_name: node[self.left_name],
-                                                     self.group_name: node.get(self.group_name, '')}, conn=conn)
-
-            if dfs_stack.is_empty():
-                if node[self.parent_name]:
-                    parent_node = await self.get_node(node[self.parent_name])
-                    if parent_node[self.parent_name]:
-                        parent_siblings = await self.get_forward_siblings(parent_node,
-                                                                          group_id=parent_node.get(self.group_name,
-                                                                                                   conn=conn))
-                        if parent_siblings and type(parent_siblings) != list:
-                            parent_siblings = [parent_siblings]
-                    else:
-                        parent_siblings = []
-                    for i in parent_siblings:
-                        dfs_stack.push((True, i, True))
-                    dfs_stack.push((False, parent_node, True))
-
-        new_node = await self._create_node(node_dict, conn=conn)
-        return new_node
+                    values.append(str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+                                  .replace('\r', '\\r'))
+            lines.append('\t'.join(values) + '\n')
+        return BytesIO(''.join(lines).encode())
+
+    async def _lock_tree(self, conn, group_id=None):
+        # renumbering reads bounds before shifting them, writers of the same tree have to take turns
+        await self._execute(conn, 'SELECT pg_advisory_xact_lock(hashtext($1));',
+                            '{}:{}'.format(self.table_name, group_id or ''))
+
+    async def _lock_node(self, conn, node_id, group_id=''):
+        # the tree lock depends on the group of the node, so the group is read before the bounds
+        groups = await self._fetch(conn, 'SELECT {group_col} FROM {table_name} WHERE id={id};'.format(
+            group_col=self.group_name, table_name=self.table_name, id=await self._param(conn, 'id', 1)), str(node_id))
+        if not groups:
+            raise RowNotFound
+        # asyncpg returns uuid groups as UUID, callers give them as text
+        if group_id and str(groups[0][self.group_name]) != str(group_id):
+            raise InvalidArgument("node is not in %s %s" % (self.group_name, group_id))
+        await self._lock_tree(conn, groups[0][self.group_name])
+        return await self._get_bounds(conn, node_id)
+
+    async def _get_bounds(self, conn, node_id):
+        nodes = await self._fetch(conn, 'SELECT {left_col}, {right_col}, {group_col} FROM {table_name} WHERE id={id} '
+                                        'FOR UPDATE;'.format(left_col=self.left_name, right_col=self.right_name,
+                                                             group_col=self.group_name, table_name=self.table_name,
+                                                             id=await self._param(conn, 'id', 1)),
+                                  str(node_id))
+        if not nodes:
+            raise RowNotFound
+        return nodes[0]
+
+    async def _select_node(self, conn, node_id):
+        nodes = await self._fetch(conn, 'SELECT * FROM {table_name} WHERE id={id};'.format(
+            table_name=self.table_name, id=await self._param(conn, 'id', 1)), str(node_id))
+        if not nodes:
+            raise RowNotFound
+        return RecordHelper.record_to_dict(nodes, normalize=[uuid_serializer])
+
+    async def _in_group(self, conn, group_id, index):
+        """
+        condition limiting a renumbering to the tree of group_id, with its parameter at $index
+        """
+        if group_id:
+            return ' AND {}={}'.format(self.group_name, await self._param(conn, self.group_name, index)), \
+                   [str(group_id)]
+        return '', []
+
+    async def _param(self, conn, column, index, array=False):
+        """
+        placeholder $index for a value of column sent as text, cast to the type of the column like the quoted literals
+        of the other queries, so that integer or uuid ids and groups compare on the column and use its indexes
+        """
+        type = (await self._types(conn)).get(column)
+        if not type:
+            return '${}'.format(index)
+        if array:
+            return '${}::text[]::{}[]'.format(index, type)
+        return '${}::text::{}'.format(index, type)
+
+    async def _types(self, conn):
+        """
+        column name to sql type of the table, looked up once
+        """
+        if self._column_types is None:
+            records = await self._fetch(conn, 'SELECT attname, format_type(atttypid, null) FROM pg_attribute '
+                                              'WHERE attrelid=$1::regclass AND attnum>0 AND NOT attisdropped;',
+                                        self.table_name)
+            self._column_types = dict((record[0], record[1]) for record in records)
+        return self._column_types
+
+    async def _new_ids(self, conn, count):
+        """
+        ids of nodes numbered before they are copied, made here for uuid ids and drawn from the default of the id
+        column otherwise, the sequence of a serial id
+        """
+        if not count or (await self._types(conn)).get('id') == 'uuid':
+            return [uuid.uuid4() for _ in range(count)]
+        defaults = await self._fetch(conn, 'SELECT pg_get_expr(adbin, adrelid) FROM pg_attrdef JOIN pg_attribute '
+                                           'ON attrelid=adrelid AND attnum=adnum '
+                                           'WHERE adrelid=$1::regclass AND attname=$2;', self.table_name, 'id')
+        if not defaults:
+            raise InvalidNodeDict('id column has no default, nodes need an id')
+        records = await self._fetch(conn, 'SELECT {} AS id FROM generate_series(1, $1);'.format(defaults[0][0]),
+                                    count)
+        return [record['id'] for record in records]
 
     def format_col_values_list(self, node_dict):
         values_list = []
@@ -281,7 +736,9 @@ class NestedCategoriesManager:
 
     @async_atomic(raise_exception=True)
     async def _create_node(self, node_dict, **kwargs):  # don't call it manually, node_dict should contain group_id
-        conn = kwargs['conn']
+        return await self._insert_node(kwargs['conn'], node_dict)
+
+    async def _insert_node(self, conn, node_dict):
         query_string = 'INSERT INTO {table_name} ({colms}) VALUES ({values}) RETURNING *;'
         query_dict = {'table_name': self.table_name,
                       'colms': '',
@@ -289,8 +746,7 @@ class NestedCategoriesManager:
         colms_list, value_list = self.format_col_values_list(node_dict)
         query_dict['colms'] = ','.join(colms_list)
         query_dict['values'] = ','.join(value_list)
-        logger.info(query_string.format(**query_dict))
-        result = await conn.fetch(query_string.format(**query_dict))
+        result = await self._fetch(conn, query_string.format(**query_dict))
         if not isinstance(result,list):
             result = [result]
         if result:
@@ -298,6 +754,7 @@ class NestedCategoriesManager:
         else:
             raise RowNotCreated
 
+    @invalidates_snapshots
     @async_atomic(raise_exception=True)
     async def _update_node(self, node_id, update_dict, **kwargs):  #node_id is unique group_id not needed
         conn = kwargs['conn']
@@ -308,8 +765,7 @@ class NestedCategoriesManager:
                       'set_str': ''}
         col, values = self.format_col_values_list(update_dict)
         query_dict['set_str'] = ','.join(("%s=%s" % (i, j) for i, j in zip(col, values)))
-        logger.info(query_str.format(**query_dict))
-        result = await conn.fetch(query_str.format(**query_dict))
+        result = await self._fetch(conn, query_str.format(**query_dict))
         if result:
             return RecordHelper.record_to_dict(result, normalize=[uuid_serializer])
         else:
@@ -319,15 +775,13 @@ class NestedCategoriesManager:
 class GroupedNestedCategories(NestedCategoriesManager):
 
 
-    @async_atomic()
-    async def _group_check(self, group_id, node_id='', conn=None):
+    async def _group_check(self, group_id, node_id=''):
+        # no connection is taken unless the group of a node has to be read
         if not node_id:
             if not group_id:
                 raise InvalidArgument("%s is required" % (self.group_name))
         else:
-            q_s = '''SELECT * FROM {table} WHERE id='{node_id}';'''.format(table=self.table_name, node_id=node_id)
-            res = await conn.fetch(q_s)
-            res = RecordHelper.record_to_dict(res, normalize=[uuid_serializer])
+            res = (await self.get_node(node_id))[0]
             if res[self.group_name] != group_id:
                 raise InvalidArgument("%s is required" % (self.group_name))
 
@@ -348,6 +802,10 @@ class GroupedNestedCategories(NestedCategoriesManager):
         x = await self._group_check(group_id)
         return await super(GroupedNestedCategories, self).get_children(parent_id, all, group_id, **kwargs)
 
+    async def get_ancestors_many(self, ids, group_id='', **kwargs):
+        x = await self._group_check(group_id)
+        return await super(GroupedNestedCategories, self).get_ancestors_many(ids, group_id, **kwargs)
+
     async def get_forward_siblings(self, node_dict, group_id='', **kwargs):
         x = await self._group_check(group_id)
         return await super(GroupedNestedCategories, self).get_forward_siblings(node_dict, group_id, **kwargs)
@@ -357,6 +815,23 @@ class GroupedNestedCategories(NestedCategoriesManager):
         x = await self._group_check(grp_id)
         return await super(GroupedNestedCategories, self).insert(node_dict, **kwargs)
 
+    async def move_subtree(self, node_id, new_parent_id, position=None, group_id='', **kwargs):
+        x = await self._group_check(group_id)
+        return await super(GroupedNestedCategories, self).move_subtree(node_id, new_parent_id, position, group_id,
+                                                                      **kwargs)
+
+    async def delete_subtree(self, node_id, group_id='', **kwargs):
+        x = await self._group_check(group_id)
+        return await super(GroupedNestedCategories, self).delete_subtree(node_id, group_id, **kwargs)
+
+    async def bulk_load(self, nodes, group_id='', **kwargs):
+        x = await self._group_check(group_id)
+        return await super(GroupedNestedCategories, self).bulk_load(nodes, group_id, **kwargs)
+
+    async def rebuild(self, group_id='', **kwargs):
+        x = await self._group_check(group_id)
+        return await super(GroupedNestedCategories, self).rebuild(group_id, **kwargs)
+
     async def _create_node(self, node_dict, **kwargs):
         grp_id = node_dict.get(self.group_name)
         x = await self._group_check(grp_id)
@@ -0,0 +1,79 @@
+import sys
+from array import array
+from bisect import bisect_left
+
+
+class TreeSnapshot:
+    """
+    Nodes of one nested set tree in left bound order, with the bounds in compact arrays. The descendants of a node are
+    the nodes after it whose left bound is below its right bound, so lookups bisect the left bounds instead of
+    querying. Rows are returned as copies, the snapshot itself is never changed.
+    """
+
+    def __init__(self, rows: list, left_name: str, right_name: str, parent_name: str):
+        """
+        :param list rows: node dicts ordered by left bound
+        """
+        self.rows = rows
+        self.parent_name = parent_name
+        self.lefts = array('q', (row[left_name] for row in rows))
+        self.rights = array('q', (row[right_name] for row in rows))
+        self.positions = dict((row['id'], position) for position, row in enumerate(rows))
+
+    def __contains__(self, node_id):
+        return str(node_id) in self.positions
+
+    def __len__(self):
+        return len(self.rows)
+
+    def node(self, node_id) -> dict:
+        return dict(self.rows[self.positions[str(node_id)]])
+
+    def has_children(self, node_id) -> bool:
+        position = self.positions[str(node_id)]
+        return self.rights[position] > self.lefts[position] + 1
+
+    def descendants(self, node_id) -> list:
+        position = self.positions[str(node_id)]
+        end = bisect_left(self.lefts, self.rights[position], position + 1)
+        return self._copies(range(position + 1, end))
+
+    def children(self, node_id) -> list:
+        # from one child to the next skipping the subtree in between
+        position = self.positions[str(node_id)]
+        end = bisect_left(self.lefts, self.rights[position], position + 1)
+        children = []
+        child = position + 1
+        while child < end:
+            children.append(child)
+            child = bisect_left(self.lefts, self.rights[child], child + 1)
+        return self._copies(children)
+
+    def leaves(self) -> list:
+        return self._copies(position for position in range(len(self.rows))
+                            if self.rights[position] == self.lefts[position] + 1)
+
+    def ancestors(self, node_id) -> list:
+        """
+        :return: ancestors of the node from the root down
+        """
+        positions = []
+        parent_id = self.rows[self.positions[str(node_id)]][self.parent_name]
+        while parent_id:
+            position = self.positions[str(parent_id)]
+            positions.append(position)
+            parent_id = self.rows[position][self.parent_name]
+        return self._copies(reversed(positions))
+
+    def memory_size(self) -> int:
+        """
+        approximate bytes held by the snapshot, its rows and their values included
+        """
+        size = sys.getsizeof(self.lefts) + sys.getsizeof(self.rights) + sys.getsizeof(self.rows)
+        size += sys.getsizeof(self.positions)
+        for row in self.rows:
+            size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+        return size
+
+    def _copies(self, positions) -> list:
+        return [dict(self.rows[position]) for position in positions]
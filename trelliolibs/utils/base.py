@@ -1,16 +1,37 @@
-from asyncio import Task, ensure_future, gather
-from asyncio.coroutines import iscoroutinefunction, coroutine
+import binascii
+import logging
+from collections import OrderedDict
+from asyncio import Queue, ensure_future
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from email.utils import formatdate, mktime_tz, parsedate_tz
 from functools import partial, wraps
-from time import time
-from types import MethodType, FunctionType
+from inspect import isawaitable
+from time import perf_counter, time
+from types import FunctionType, MethodType
+from zlib import crc32
 
-from asyncpg.exceptions import UniqueViolationError, UndefinedColumnError
+from aiohttp.web import Response, StreamResponse
+from asyncpg.exceptions import DataError, UniqueViolationError, UndefinedColumnError
 from trellio import request, get, put, post, delete, api
 from trellio.utils.ordered_class_member import OrderedClassMembers
 from trelliopg import get_db_adapter
 
-from .decorators import TrellioValidator
-from .helpers import RecordHelper, uuid_serializer, json_response, json_serializer
+from .cache import RecordCache, CacheInvalidator
+from .decorators import get_validator
+from .helpers import RecordHelper, RecordEncoder, RowSerializer, uuid_serializer, json_response, json_serializer, \
+    paginated_json_response, request_json, compress_response, ExportEncoder, EXPORT_CONTENT_TYPES, \
+    PAYLOAD_SECONDS_KEY, COMPRESS_MIN_SIZE
+from .loaders import BatchLoader, SingleFlight, coalesce
+from .metrics import Metrics, PROMETHEUS_CONTENT_TYPE
+from .querylog import LoggedConnection, SlowQueryLog
+from .sql import QueryBuilder, MAX_PARAMS
+
+try:
+    import ujson as json
+except:
+    import json
+
+logger = logging.getLogger(__name__)
 
 
 class RecordNotFound(Exception):
@@ -21,6 +42,53 @@ class RequestKeyError(Exception):
     pass
 
 
+class InvalidCursor(Exception):
+    pass
+
+
+class InvalidFields(Exception):
+    pass
+
+
+def encode_cursor(value, id, direction='next', order_by=('created', 'desc')) -> str:
+    """
+    build an opaque pagination cursor pointing just past (or before) a record
+
+    :param value: value of the order_by column of the record
+    :param id: id of the record, used as tie breaker
+    :param str direction: 'next' to seek after the record, 'prev' to seek before it
+    :param tuple order_by: (column, 'asc' or 'desc') of the page, the cursor is only valid for that order
+    """
+    data = json.dumps([value, id, direction] + list(order_by)).encode('utf-8')
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    :return: value, id, direction and order_by given to encode_cursor
+    """
+    try:
+        data = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, id, direction, column, order = json.loads(data.decode('utf-8'))
+    except (binascii.Error, ValueError, TypeError):
+        raise InvalidCursor('invalid cursor {}'.format(cursor))
+
+    if direction not in ('next', 'prev'):
+        raise InvalidCursor('invalid cursor {}'.format(cursor))
+    return value, id, direction, (column, order)
+
+
+def split_order_by(order_by: str) -> tuple:
+    parts = order_by.split()
+    if ',' in order_by or not 0 < len(parts) <= 2:
+        raise InvalidCursor('cursor pagination needs a single order_by column, got {}'.format(order_by))
+
+    direction = parts[1].lower() if len(parts) == 2 else 'asc'
+    if direction not in ('asc', 'desc'):
+        raise InvalidCursor('invalid order_by direction {}'.format(parts[1]))
+    return parts[0], direction
+
+
 def view_wrapper(view):
     @wraps(view)
     async def f(self, request, *args, **kwargs):
@@ -34,6 +102,44 @@ def view_wrapper(view):
     return f
 
 
+def handler_timer(handler):
+    """
+    observe the time spent in a service handler and the size of the response body, when the service has metrics
+    """
+    name = handler.__name__
+
+    @wraps(handler)
+    async def f(self, *args, **kwargs):
+        metrics = self._metrics
+        if metrics is None:
+            return await handler(self, *args, **kwargs)
+
+        with metrics.timer('handler_seconds', table=self._table_name, handler=name):
+            result = await handler(self, *args, **kwargs)
+        body = getattr(result, 'body', None)
+        if isinstance(body, bytes):
+            metrics.observe('response_bytes', len(body), table=self._table_name, handler=name)
+        return result
+
+    return f
+
+
+def compressed(handler):
+    """
+    compress the response of an http handler with the encoding the request accepts, unless compress_level is 0
+    """
+
+    @wraps(handler)
+    async def f(self, service, request, *args, **kwargs):
+        response = await handler(self, service, request, *args, **kwargs)
+        if not self._compress_level:
+            return response
+        return await compress_response(request, response, level=self._compress_level,
+                                       min_size=self._compress_min_size)
+
+    return f
+
+
 class WrappedViewMeta(OrderedClassMembers):
     def __new__(self, name, bases, classdict):
 
@@ -57,6 +163,10 @@ def extract_request_params(request, filter_keys=()):
         params['offset'] = request.pop('offset')
     if request.get('order_by'):
         params['order_by'] = request.pop('order_by')
+    if 'cursor' in request:
+        params['cursor'] = request.pop('cursor')
+    if request.get('fields'):
+        params['fields'] = request.pop('fields').split(',')
 
     if filter_keys:
         wrong_keys = [key for key in request.keys() if key not in filter_keys]
@@ -70,139 +180,613 @@ def extract_request_params(request, filter_keys=()):
     return params
 
 
-class SignalMethodWrapper:
+class SignalQueue:
     """
-    Wrapper object for a method to be called.
+    Runs post signals in the background, in order, from a bounded queue. Callers wait for room when the queue is full
+    so slow signals hold back the calls producing them instead of piling up tasks. Failing signals are logged and
+    counted.
     """
 
-    def __init__(self, instance, func, name):
-        self.instance, self.func, self.name = instance, func, name
-        assert instance is not None
-        assert func is not None
-        assert name is not None
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.errors = 0
+        self._queue = None
+        self._worker = None
+
+    async def put(self, signal, result, args, kwargs):
+        if self._queue is None:
+            # created on first use so it belongs to the running loop
+            self._queue = Queue(maxsize=self.maxsize)
+        if self._worker is None or self._worker.done():
+            self._worker = ensure_future(self._run())
+        await self._queue.put((signal, result, args, kwargs))
+
+    async def join(self):
+        """
+        wait until every queued signal has run
+        """
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _run(self):
+        while True:
+            signal, result, args, kwargs = await self._queue.get()
+            try:
+                done = signal(result, *args, **kwargs)
+                if isawaitable(done):
+                    await done
+            except Exception:
+                self.errors += 1
+                logger.exception('post signal %s failed', getattr(signal, '__qualname__', signal))
+            finally:
+                self._queue.task_done()
+
+
+def signal_wrapper(method, pre_signal, post_signal):
+    @wraps(method)
+    async def f(self, *args, **kwargs):
+        if self._signals and pre_signal:
+            done = pre_signal(self, None, *args, **kwargs)
+            if isawaitable(done):
+                await done
+
+        result = method(self, *args, **kwargs)
+        if isawaitable(result):
+            result = await result
+        if self._signals and post_signal:
+            await self._post_signals.put(MethodType(post_signal, self), result, args, kwargs)
+        return result
+
+    f.signal_method = method
+    return f
 
-    def __call__(self, *args, **kwargs):
-        return self.instance._run_signals(self.name, self.func, *args, **kwargs)
 
+class SignalMeta(type):
+    """
+    Wraps the registered methods having a pre_<method> or post_<method> signal when the class is defined, methods
+    without signals are left as they are.
+    """
 
-class BaseSignal:
+    def __new__(self, name, bases, classdict):
+        cls = super().__new__(self, name, bases, classdict)
+        for method_name in cls.registered_methods:
+            method = getattr(cls, method_name, None)
+            if method is None:
+                continue
+
+            method = getattr(method, 'signal_method', method)
+            pre_signal = getattr(cls, 'pre_{}'.format(method_name), None)
+            post_signal = getattr(cls, 'post_{}'.format(method_name), None)
+            if pre_signal or post_signal:
+                setattr(cls, method_name, signal_wrapper(method, pre_signal, post_signal))
+            else:
+                setattr(cls, method_name, method)
+        return cls
+
+
+class BaseSignal(metaclass=SignalMeta):
+    """
+    Signals are methods named pre_<method> and post_<method> for the methods in registered_methods, they get the
+    result (None for pre signals) followed by the arguments of the call. Pre signals run before the call, post signals
+    run in the background through a SignalQueue of post_signal_queue_size.
+    """
     registered_methods = []
+    post_signal_queue_size = 1024
 
     def __init__(self, signals: bool = True):
-        if signals:
-            self._enable_signals()
-
-    def _enable_signals(self):
-        for method in self.registered_methods:
-            func = getattr(self, method)
-            if type(func) is MethodType:
-                wrapper = SignalMethodWrapper(self, func, method)
-                setattr(self, method, wrapper)
-
-    def _run_signals(self, name, func, *args, **kwargs):
-        pre_signal = getattr(self, 'pre_{}'.format(name), None)
-        post_signal = getattr(self, 'post_{}'.format(name), None)
-
-        if pre_signal:
-            self._run_coroutine(pre_signal, *args, **kwargs)
-
-        wrapped_func = func
-        if not iscoroutinefunction(func):
-            wrapped_func = coroutine(func)
-
-        future = ensure_future(wrapped_func(*args, **kwargs))
-        if post_signal:
-            future.add_done_callback(partial(self._run_coroutine, post_signal, *args, **kwargs))
-        return future
-
-    def _run_coroutine(self, coro, *args, **kwargs):
-        print(locals())
-        args = list(args)
-        result = None
-        if len(args) > 0 and type(args[-1]) is Task:
-            task = args.pop()
-            result = task.result()
-
-        wrapper_coro = coro
-        if not iscoroutinefunction(coro):
-            wrapper_coro = coroutine(coro)
-
-        ensure_future(wrapper_coro(result, *args, **kwargs))
+        self._signals = signals
+        self._post_signals = SignalQueue(maxsize=self.post_signal_queue_size)
 
 
 class CRUDModel(BaseSignal):
     registered_methods = ['get', 'filter', 'create', 'update', 'delete']
 
-    def __init__(self, table: str = '', json_fields: list = (), signals: bool = True):
+    coalesce_methods = ('get', 'get_many', 'filter', 'search', 'paginate', 'count', 'freshness')
+
+    def __init__(self, table: str = '', json_fields: list = (), signals: bool = True, cache: RecordCache = None,
+                 invalidator: CacheInvalidator = None, coalesce: tuple = (), batch_get: bool = False,
+                 metrics: Metrics = None, slow_log: SlowQueryLog = None):
+        """
+        :param RecordCache cache: opt-in read-through cache for get, entries are dropped by create, update and delete
+        :param CacheInvalidator invalidator: publishes writes with NOTIFY and evicts writes from other nodes
+        :param tuple coalesce: read methods whose concurrent identical calls share one query, see coalesce_methods
+        :param bool batch_get: gets by id made in the same turn of the event loop are loaded with one get_many
+        :param Metrics metrics: records pool wait, query time, rows and serialization time per operation
+        :param SlowQueryLog slow_log: logs and aggregates queries over its threshold
+        """
+        wrong_methods = [method for method in coalesce if method not in self.coalesce_methods]
+        if wrong_methods:
+            raise ValueError('{} can not be coalesced. Allowed methods - {}'.format(', '.join(wrong_methods),
+                                                                                ', '.join(self.coalesce_methods)))
         super(CRUDModel, self).__init__(signals=signals)
         self._table = table
         self._db = get_db_adapter()
         self._record = RecordHelper()
+        self._json_fields = json_fields
         self._serializers = [uuid_serializer, partial(json_serializer, fields=json_fields)]
+        self._row_serializer = None
+        self._record_encoder = None
+        self._cache = cache
+        self._invalidator = invalidator
+        self._column_types = None
+        self._not_null = None
+        self._query_builder = None
+        self._flights = {method: SingleFlight() for method in coalesce}
+        self._loader = BatchLoader(self.get_many) if batch_get else None
+        self._metrics = metrics
+        self._slow_log = slow_log
+        if invalidator is not None and cache is not None:
+            invalidator.register(table, cache)
+
+    @property
+    def coalesced(self) -> dict:
+        """
+        calls served by a query already in flight, per coalesced method
+        """
+        return {method: flight.coalesced for method, flight in self._flights.items()}
+
+    async def _queries(self, con) -> QueryBuilder:
+        if self._query_builder is None:
+            types = await self._columns(con)
+            self._row_serializer = RowSerializer(types, not_null=self._not_null, json_fields=self._json_fields)
+            self._record_encoder = RecordEncoder(types, not_null=self._not_null, json_fields=self._json_fields)
+            self._query_builder = QueryBuilder(self._table, types)
+        return self._query_builder
+
+    def _connection(self, operation: str) -> 'PoolConnection':
+        return PoolConnection(self, operation)
+
+    def _to_dict(self, records, operation: str = ''):
+        """
+        serialized records, through the serializer compiled from the column types once they are known
+        """
+        serialize = self._row_serializer
+        if serialize is None:
+            serialize = partial(self._record.record_to_dict, normalize=self._serializers)
+        if self._metrics is None:
+            return serialize(records)
+
+        start = perf_counter()
+        result = serialize(records)
+        self._observe(operation, perf_counter() - start, records)
+        return result
+
+    def encode(self, records) -> bytes:
+        """
+        json bytes of records as returned with raw=True, or of serialized records
+        """
+        encode = self._record_encoder
+        if encode is None:
+            encode = lambda data: json.dumps(data).encode('utf-8')
+        if self._metrics is None:
+            return encode(records)
+
+        start = perf_counter()
+        result = encode(records)
+        self._observe('encode', perf_counter() - start, records)
+        return result
+
+    def _observe(self, operation, seconds, records):
+        self._metrics.observe('serialize_seconds', seconds, table=self._table, operation=operation)
+        self._metrics.observe('rows', len(records) if isinstance(records, list) else 1, table=self._table,
+                              operation=operation)
+
+    async def _columns(self, con) -> OrderedDict:
+        """
+        column name to sql type of the table, looked up once, without modifiers so that casts to it never truncate or
+        round a value, the column does on assignment and raises when it has to
+        """
+        if self._column_types is None:
+            results = await con.fetch("""select attname, format_type(atttypid, null), attnotnull from pg_attribute
+                                         where attrelid = $1::regclass and attnum > 0 and not attisdropped
+                                         order by attnum""", self._table)
+            self._not_null = {result[0] for result in results if result[2]}
+            self._column_types = OrderedDict((result[0], result[1]) for result in results)
+        return self._column_types
+
+    def _projection(self, fields, types, required=()) -> str:
+        """
+        select list for the requested fields, checked against the table columns
+        """
+        if not fields:
+            return '*'
+        if isinstance(fields, str):
+            fields = fields.split(',')
+
+        fields = [field.strip() for field in fields if field.strip()]
+        wrong_fields = [field for field in fields if field not in types]
+        if wrong_fields:
+            raise InvalidFields('{} fields not found. Allowed fields - {}'.format(', '.join(wrong_fields),
+                                                                               ', '.join(types)))
+        fields.extend(column for column in required if column not in fields)
+        return ','.join(fields)
+
+    async def _count(self, con, filter) -> int:
+        queries = await self._queries(con)
+        query, args = queries.select(filter, columns='count(*)')
+        return int(await con.fetchval(query, *args))
+
+    async def _estimate_count(self, con, filter) -> int:
+        if not filter:
+            result = await con.fetchval("""select reltuples::bigint from pg_class where oid = $1::regclass""",
+                                        self._table)
+        else:
+            queries = await self._queries(con)
+            query, args = queries.select(filter, columns='1')
+            plan = await con.fetchval("""explain (format json) {}""".format(query), *args)
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            result = plan[0]['Plan']['Plan Rows']
 
-    async def count(self, **filter) -> int:
-        query = """select count(id) from {}""".format(self._table)
-        if filter:
-            query += self._db._where_query(filter, None, None, None)
-
-        pool = await self._db.get_pool()
-        async with pool.acquire() as con:
-            results = await con.fetchrow(query)
+        # reltuples is -1 for tables that were never vacuumed or analyzed
+        return max(int(result), 0)
 
-        return int(results[0])
+    @coalesce
+    async def count(self, **filter) -> int:
+        async with self._connection('count') as con:
+            return await self._count(con, filter)
+
+    @coalesce
+    async def freshness(self, **filter) -> dict:
+        """
+        newest updated value and number of the records matching filter, a cheap probe for conditional requests
+        """
+        async with self._connection('freshness') as con:
+            queries = await self._queries(con)
+            query, args = queries.select(filter, columns='max(updated) as updated, count(*) as count')
+            record = await con.fetchrow(query, *args)
+        return {'updated': record['updated'], 'count': record['count']}
+
+    async def estimate_count(self, **filter) -> int:
+        """
+        row count estimated by the planner, pg_class.reltuples when unfiltered, cheap on tables of any size
+        """
+        async with self._connection('estimate_count') as con:
+            return await self._estimate_count(con, filter)
+
+    @coalesce
+    async def get(self, fields=None, raw=False, **where) -> dict:
+        """
+        :param fields: columns to select, all of them by default
+        :param bool raw: return the asyncpg record read from the database, for encode, cached records stay dicts
+        """
+        if self._loader is not None and list(where) == ['id']:
+            record = await self._loader.load(str(where['id']))
+            if record is None:
+                raise RecordNotFound('record does not exists')
+            if fields:
+                columns = self._projection(fields, record).split(',')
+                return {column: record[column] for column in columns}
+            return dict(record)
+
+        if self._cache is not None:
+            if self._invalidator is not None:
+                await self._invalidator.listen()
+            key = self._cache.make_key(self._table, where)
+            generation = self._cache.generation(self._table)
+            record = self._cache.get(key)
+            if record is not None:
+                if fields:
+                    columns = self._projection(fields, record).split(',')
+                    return {column: record[column] for column in columns}
+                return dict(record)
+
+        async with self._connection('get') as con:
+            queries = await self._queries(con)
+            columns = self._projection(fields, queries.types)
+            query, args = queries.select(where, columns=columns, order_by='created desc', limit=1)
+            results = await con.fetch(query, *args)
 
-    async def get(self, **where) -> dict:
-        results = await self._db.where(table=self._table, **where)
         if len(results) == 0:
             raise RecordNotFound('record does not exists')
 
-        return self._record.record_to_dict(results[0], normalize=self._serializers)
+        if raw and self._cache is None:
+            return results[0]
+
+        record = self._to_dict(results[0], 'get')
+        if self._cache is not None and not fields:
+            # only whole rows are cached, projections are served from them
+            self._cache.set(key, record, generation=generation)
+            return dict(record)
+        return record
+
+    @coalesce
+    async def get_many(self, ids, fields=None) -> list:
+        """
+        records of ids in one query
+        :return: a record or None per id, in the order of ids
+        """
+        ids = [str(id) for id in ids]
+        found = dict()
+        if self._cache is not None and not fields:
+            if self._invalidator is not None:
+                await self._invalidator.listen()
+            generation = self._cache.generation(self._table)
+            for id in ids:
+                record = self._cache.get(self._cache.make_key(self._table, {'id': id}))
+                if record is not None:
+                    found[id] = record
+
+        missing = [id for id in OrderedDict.fromkeys(ids) if id not in found]
+        if missing:
+            async with self._connection('get_many') as con:
+                queries = await self._queries(con)
+                columns = self._projection(fields, queries.types, required=('id',))
+                query, args = queries.select({'id__in': missing}, columns=columns)
+                results = await con.fetch(query, *args)
+
+            # id is only selected to match the rows with ids when it was not asked for
+            strip_id = fields and 'id' not in self._projection(fields, queries.types).split(',')
+            for record in self._to_dict(results, 'get_many'):
+                if strip_id:
+                    found[str(record.pop('id'))] = record
+                    continue
+                found[str(record['id'])] = record
+                if self._cache is not None and not fields:
+                    self._cache.set(self._cache.make_key(self._table, {'id': record['id']}), record,
+                                    generation=generation)
+
+        return [dict(found[id]) if id in found else None for id in ids]
 
     async def create(self, values: dict) -> dict:
         values['created'] = int(time())
         values['updated'] = values['created']
-        record = await self._db.insert(table=self._table, value_dict=values)
-        return self._record.record_to_dict(record, normalize=self._serializers)
 
-    async def filter(self, limit=None, offset=None, order_by='created desc', **filter) -> list:
-        record = await self._db.where(table=self._table, offset=offset, limit=limit, order_by=order_by, **filter)
-        return self._record.record_to_dict(record, normalize=self._serializers)
+        async with self._connection('create') as con:
+            queries = await self._queries(con)
+            columns = tuple(values)
+            async with self._writing(con):
+                record = await con.fetchrow(queries.insert(columns), *[values[c] for c in columns])
+                await self._publish(con, records=[record])
+
+        record = self._to_dict(record, 'create')
+        self._invalidate(records=[record])
+        return record
+
+    async def bulk_create(self, rows: list, returning: bool = False, chunk_size: int = 1000):
+        """
+        insert many rows in one transaction, streamed with COPY unless the inserted records are needed in which case
+        multi row INSERT ... RETURNING statements are used, consecutive rows sharing the same columns go together
+
+        :return: number of inserted rows, or the inserted records when returning is set
+        """
+        now = int(time())
+        for values in rows:
+            values['created'] = now
+            values['updated'] = now
+
+        results = []
+        async with self._connection('bulk_create') as con:
+            queries = await self._queries(con)
+            async with con.transaction():
+                # COPY has no bind parameter limit
+                for columns, chunk in self._chunks(rows, chunk_size, max_params=MAX_PARAMS if returning else None):
+                    if returning:
+                        query = queries.insert(columns, len(chunk))
+                        results.extend(await con.fetch(query, *[values[c] for values in chunk for c in columns]))
+                    else:
+                        await con.copy_records_to_table(self._table, columns=columns,
+                                                        records=[tuple(values[c] for c in columns) for values in chunk])
+                # rows copied without returning have no id yet, their values still match cached where clauses
+                await self._publish(con, records=results if returning else rows)
+
+        if not returning:
+            self._invalidate(records=rows)
+            return len(rows)
+
+        records = self._to_dict(results, 'bulk_create')
+        self._invalidate(records=records)
+        return records
+
+    async def bulk_update(self, rows: list, key: str = 'id', chunk_size: int = 1000) -> list:
+        """
+        update many rows in one transaction, each chunk of rows becomes a single UPDATE ... FROM (VALUES ...) joined
+        on key, every row needs a key value and the columns it sets
+        """
+        now = int(time())
+        for values in rows:
+            values['updated'] = now
+
+        results = []
+        async with self._connection('bulk_update') as con:
+            queries = await self._queries(con)
+            async with con.transaction():
+                for columns, chunk in self._chunks(rows, chunk_size, max_params=MAX_PARAMS):
+                    if key not in columns:
+                        raise ValueError('{} missing in bulk update row {}'.format(key, chunk[0]))
+
+                    query = queries.update_from_values(columns, len(chunk), key)
+                    results.extend(await con.fetch(query, *queries.values(columns, chunk)))
+                await self._publish(con, records=results)
+
+        records = self._to_dict(results, 'bulk_update')
+        self._invalidate(records=records)
+        return records
+
+    async def upsert(self, rows: list, conflict_cols=('id',), chunk_size: int = 1000) -> list:
+        """
+        insert rows or update the existing ones with INSERT ... ON CONFLICT DO UPDATE, created is only set on insert,
+        a chunk must not hold two rows with the same conflict_cols values
+        """
+        now = int(time())
+        for values in rows:
+            values['created'] = now
+            values['updated'] = now
+
+        results = []
+        async with self._connection('upsert') as con:
+            queries = await self._queries(con)
+            async with con.transaction():
+                for columns, chunk in self._chunks(rows, chunk_size, max_params=MAX_PARAMS):
+                    updates = [c for c in columns if c not in conflict_cols and c != 'created']
+                    on_conflict = ' on conflict ({}) do update set {}'.format(
+                        ','.join(conflict_cols), ','.join('{0} = excluded.{0}'.format(c) for c in updates))
+                    query = queries.insert(columns, len(chunk), on_conflict=on_conflict, cast=True)
+                    results.extend(await con.fetch(query, *queries.values(columns, chunk)))
+                await self._publish(con, records=results)
+
+        records = self._to_dict(results, 'upsert')
+        self._invalidate(records=records)
+        return records
+
+    @staticmethod
+    def _chunks(rows, chunk_size, max_params=None):
+        """
+        split rows in runs sharing the same columns, at most chunk_size rows long and holding at most max_params values
+        """
+        chunk, columns, size = [], None, chunk_size
+        for values in rows:
+            keys = tuple(values.keys())
+            if keys != columns or len(chunk) >= size:
+                if chunk:
+                    yield columns, chunk
+                chunk, columns = [], keys
+                size = chunk_size if not max_params else max(1, min(chunk_size, max_params // len(keys)))
+            chunk.append(values)
+        if chunk:
+            yield columns, chunk
+
+    @coalesce
+    async def filter(self, limit=None, offset=None, order_by='created desc', fields=None, raw=False, **filter) -> list:
+        """
+        :param bool raw: return the asyncpg records, for encode
+        """
+        async with self._connection('filter') as con:
+            queries = await self._queries(con)
+            columns = self._projection(fields, queries.types)
+            query, args = queries.select(filter, columns=columns, order_by=order_by, offset=offset, limit=limit)
+            record = await con.fetch(query, *args)
+        if raw:
+            return record
+        return self._to_dict(record, 'filter')
 
     async def delete(self, is_active=False, **where):
-        if is_active == False:
-            return await self._db.update(table=self._table, where_dict=where, is_active=False)
-        else:
-            return await self._db.delete(table=self._table, where_dict=where)
-
+        async with self._connection('delete') as con:
+            queries = await self._queries(con)
+            async with self._writing(con):
+                if is_active == False:
+                    # soft deletes move updated too so conditional requests see them
+                    query, args = queries.update({'is_active': False, 'updated': int(time())}, where)
+                    result = self._to_dict(await con.fetch(query, *args), 'delete')
+                else:
+                    query, args = queries.delete(where)
+                    await con.execute(query, *args)
+                    result = None
+                await self._publish(con, where=where)
+        self._invalidate(where=where)
+        return result
+
+    def stream(self, batch_size: int = 500, order_by: str = 'created desc', fields=None, **filter) -> 'RecordStream':
+        """
+        read matching records in batches through a server side cursor, see RecordStream
+        """
+        return RecordStream(self, filter, order_by=order_by, batch_size=batch_size, fields=fields)
+
+    @coalesce
     async def search(self, limit, columns='*', **where):
-        record = await self._db.where(table=self._table, columns=columns, limit=limit, **where)
-        return self._record.record_to_dict(record, normalize=self._serializers)
+        async with self._connection('search') as con:
+            queries = await self._queries(con)
+            query, args = queries.select(where, columns=columns, order_by='created desc', limit=limit)
+            record = await con.fetch(query, *args)
+        return self._to_dict(record, 'search')
 
     async def update(self, where_dict: dict, values: dict) -> dict:
         values['updated'] = int(time())
-        result = await self._db.update(table=self._table, where_dict=where_dict, **values)
-        return self._record.record_to_dict(result, normalize=self._serializers)
-
-    async def paginate(self, limit=15, offset: int = 0, order_by: str = 'created desc', **filter) -> dict:
-        coros = [self.filter(limit=limit, offset=offset, order_by=order_by, **filter), self.count(**filter)]
-        records, count = await gather(*coros, return_exceptions=True)
-        if isinstance(records, Exception):
-            raise records
-        if isinstance(count, Exception):
-            raise count
-
+        async with self._connection('update') as con:
+            queries = await self._queries(con)
+            query, args = queries.update(values, where_dict)
+            async with self._writing(con):
+                result = await con.fetch(query, *args)
+                await self._publish(con, where=where_dict, records=result)
+        records = self._to_dict(result, 'update')
+        self._invalidate(where=where_dict, records=records)
+        return records
+
+    def _writing(self, con):
+        """
+        transaction of a single statement write when its change is published, so the notification goes out on commit
+        """
+        if self._invalidator is None:
+            return NoTransaction()
+        return con.transaction()
+
+    async def _publish(self, con, where: dict = None, records=()):
+        if self._invalidator is not None:
+            await self._invalidator.publish(self._table, where=where, records=records, con=con)
+
+    def _invalidate(self, where: dict = None, records=()):
+        if self._cache is not None:
+            self._cache.invalidate(self._table, where=where, records=records)
+
+    @coalesce
+    async def paginate(self, limit=15, offset: int = 0, order_by: str = 'created desc', cursor: str = None,
+                       total: str = 'exact', fields=None, **filter) -> dict:
+        """
+        fetch a page of records and the total in a single statement
+
+        :param str total: 'exact' counts matching rows with a window over the page query, 'estimate' uses the planner
+                          row estimate and 'none' skips counting, both of the latter look one row ahead to find out
+                          whether there is a next page
+        """
+        if cursor is not None:
+            return await self._cursor_paginate(limit=limit, order_by=order_by, cursor=cursor, fields=fields, **filter)
+
+        if total not in ('exact', 'estimate', 'none'):
+            raise ValueError("total should be one of 'exact', 'estimate' or 'none', got {}".format(total))
+
+        offset = int(offset or 0)
+        limit = None if limit == 'ALL' or limit is None else int(limit)
+
+        count = None
+        async with self._connection('paginate') as con:
+            queries = await self._queries(con)
+            columns = self._projection(fields, queries.types)
+            if total == 'exact':
+                query, args = queries.select(filter, columns=columns + ', count(*) over() as _total_count',
+                                             order_by=order_by, offset=offset, limit=limit or 'ALL')
+            else:
+                query, args = queries.select(filter, columns=columns, order_by=order_by, offset=offset,
+                                             limit=limit + 1 if limit else 'ALL')
+            results = await con.fetch(query, *args)
+            if total == 'exact' and results:
+                count = results[0]['_total_count']
+            elif total == 'exact' and offset:
+                # page past the end, the window has no row to report the total on
+                count = await self._count(con, filter)
+            elif total == 'estimate':
+                count = await self._estimate_count(con, filter)
+
+        records = self._to_dict(results, 'paginate')
+
+        if total == 'exact':
+            for record in records:
+                record.pop('_total_count')
+            return self._page(records, count or 0, limit, offset)
+
+        has_more = limit is not None and len(records) > limit
+        records = records[:limit]
+        if count is not None and records and not has_more:
+            count = offset + len(records)
+        if count is not None:
+            page = self._page(records, max(count, offset + len(records)), limit, offset)
+            if page['total_records']:
+                page['next_offset'] = offset + limit if has_more else None
+            return page
+
+        if limit is None:
+            limit = len(records)
+        return {'records': records, 'next_offset': offset + limit if has_more else None,
+                'prev_offset': offset - limit if offset else None, 'last_offset': None, 'total_pages': None,
+                'total_records': None, 'limit': limit}
+
+    @staticmethod
+    def _page(records, count, limit, offset):
         if count == 0:
             return {'records': [], 'total_pages': 0, 'total_records': 0, 'limit': limit}
 
-        if offset is None:
-            offset = 0
-
-        if limit == 'ALL' or limit is None:
+        if limit is None:
             limit = count
 
-        limit = int(limit)
-        offset = int(offset)
-
         total_pages = (count // limit) + 1
 
         last_offset = limit * (total_pages - 1)
@@ -218,10 +802,204 @@ class CRUDModel(BaseSignal):
         return {'records': records, 'next_offset': next_offset, 'prev_offset': prev_offset, 'last_offset': last_offset,
                 'total_pages': total_pages, 'total_records': count, 'limit': limit}
 
+    async def _cursor_paginate(self, limit=15, order_by: str = 'created desc', cursor: str = '', fields=None,
+                               **filter) -> dict:
+        """
+        keyset pagination, seeks on (order_by column, id) instead of using offset so every page costs the same,
+        an empty cursor returns the first page, nulls of the column come last
+        """
+        column, direction = split_order_by(order_by)
+        if limit == 'ALL' or limit is None:
+            limit = 15
+        limit = int(limit)
+
+        seek, backwards = (), False
+        if cursor:
+            value, id, way, cursor_order = decode_cursor(cursor)
+            # a value of another column would be seeked on this one, a silently wrong page or a failed cast
+            if cursor_order != (column, direction):
+                raise InvalidCursor('cursor was made for order_by {} {}'.format(*cursor_order))
+            seek, backwards = (value, id), way == 'prev'
+
+        descending = (direction == 'desc') != backwards
+        async with self._connection('paginate') as con:
+            queries = await self._queries(con)
+            if column not in queries.types:
+                raise InvalidCursor('unknown order_by column {}'.format(column))
+            nulls = None
+            if column != 'id' and column not in self._not_null:
+                nulls = 'first' if backwards else 'last'
+            if seek:
+                seek = (column, '<' if descending else '>', nulls) + seek
+            order_by = '{col} {dir}{nulls}, id {dir}'.format(col=column, dir='desc' if descending else 'asc',
+                                                             nulls=' nulls {}'.format(nulls) if nulls else '')
+            columns = self._projection(fields, queries.types, required=(column, 'id'))
+            query, args = queries.select(filter, columns=columns, order_by=order_by, limit=limit + 1,
+                                         seek=seek or None)
+            try:
+                results = await con.fetch(query, *args)
+            except DataError:
+                if not seek:
+                    raise
+                raise InvalidCursor('invalid cursor {}'.format(cursor))
+
+        has_more = len(results) > limit
+        results = results[:limit]
+        if backwards:
+            results.reverse()
+
+        next_cursor, prev_cursor = None, None
+        if results:
+            # cursors hold the column values as text, bound back with the column cast like filter values
+            first, last = results[0], results[-1]
+            if has_more or backwards:
+                next_cursor = encode_cursor(queries.text(last[column]), str(last['id']), 'next', (column, direction))
+            if cursor and (has_more or not backwards):
+                prev_cursor = encode_cursor(queries.text(first[column]), str(first['id']), 'prev', (column, direction))
+
+        records = self._to_dict(results, 'paginate')
+
+        if fields:
+            # the seek columns were only selected to build the cursors
+            extra = {column, 'id'} - set(self._projection(fields, queries.types).split(','))
+            for record in records:
+                for key in extra:
+                    record.pop(key)
+
+        return {'records': records, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor, 'limit': limit}
+
+
+class NoTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class PoolConnection:
+    """
+    Acquires a pool connection for a model operation, timing the wait and how long the connection is held when the
+    model has metrics. The connection goes through a LoggedConnection when the model has a slow query log.
+    """
+
+    def __init__(self, model: CRUDModel, operation: str):
+        self._model = model
+        self._operation = operation
+        self._pool = None
+        self._con = None
+        self._start = None
+
+    async def __aenter__(self):
+        self._pool = await self._model._db.get_pool()
+        metrics = self._model._metrics
+        if metrics is None:
+            self._con = await self._pool.acquire()
+        else:
+            start = perf_counter()
+            self._con = await self._pool.acquire()
+            self._start = perf_counter()
+            metrics.observe('pool_wait_seconds', self._start - start, table=self._model._table,
+                            operation=self._operation)
+
+        if self._model._slow_log is not None:
+            return LoggedConnection(self._con, self._model._slow_log)
+        return self._con
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if self._start is not None:
+                self._model._metrics.observe('query_seconds', perf_counter() - self._start, table=self._model._table,
+                                             operation=self._operation)
+        finally:
+            await self._pool.release(self._con)
+
+
+class RecordStream:
+    """
+    Async iterator over lists of serialized records read through a server side cursor. A pooled connection and its
+    transaction are held until the stream is exhausted or closed, use it as a context manager when the iteration can
+    stop early::
+
+        async with model.stream(batch_size=1000, is_active=True) as batches:
+            async for records in batches:
+                ...
+    """
+
+    def __init__(self, model: CRUDModel, filter: dict, order_by: str = 'created desc', batch_size: int = 500,
+                 fields=None):
+        self._model = model
+        self._filter = filter
+        self._order_by = order_by
+        self._batch_size = batch_size
+        self._fields = fields
+        self._pool = None
+        self._con = None
+        self._transaction = None
+        self._cursor = None
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> list:
+        if self._closed:
+            raise StopAsyncIteration
+
+        try:
+            if self._cursor is None:
+                await self._open()
+            results = await self._cursor.fetch(self._batch_size)
+        except Exception:
+            await self.close()
+            raise
+
+        if not results:
+            await self.close()
+            raise StopAsyncIteration
+        return self._model._to_dict(results, 'stream')
+
+    async def _open(self):
+        self._pool = await self._model._db.get_pool()
+        if self._model._metrics is None:
+            self._con = await self._pool.acquire()
+        else:
+            with self._model._metrics.timer('pool_wait_seconds', table=self._model._table, operation='stream'):
+                self._con = await self._pool.acquire()
+        self._transaction = self._con.transaction()
+        await self._transaction.start()
+
+        queries = await self._model._queries(self._con)
+        columns = self._model._projection(self._fields, queries.types)
+        query, args = queries.select(self._filter, columns=columns, order_by=self._order_by)
+        self._cursor = await self._con.cursor(query, *args)
+
+    async def close(self):
+        self._closed = True
+        if self._con is None:
+            return
+
+        con, self._con, self._cursor = self._con, None, None
+        try:
+            if self._transaction is not None:
+                await self._transaction.rollback()
+        finally:
+            await self._pool.release(con)
+
 
 class CRUDTCPClient:
     @request
-    def get_record(self, id):
+    def get_record(self, id, fields=None):
+        return locals()
+
+    @request
+    def get_records(self, ids, fields=None):
         return locals()
 
     @request
@@ -232,6 +1010,10 @@ class CRUDTCPClient:
     def create_record(self, values):
         return locals()
 
+    @request
+    def bulk_create_records(self, values, returning=False):
+        return locals()
+
     @request
     def update_record(self, id, values):
         return locals()
@@ -243,10 +1025,25 @@ class CRUDTCPClient:
 
 class CRUDHTTPService:
     def __init__(self, name, version, host, port, table_name='', base_uri='', required_params=(), state_key=None,
-                 create_schema=None, update_schema=None, allow_unknown=False, json_fields=()):
+                 create_schema=None, update_schema=None, allow_unknown=False, json_fields=(), cache=None,
+                 invalidator=None, coalesce=(), metrics=None, slow_log=None, compress_level=6,
+                 compress_min_size=COMPRESS_MIN_SIZE, etags=True, filter_etags=False):
+        """
+        :param int compress_level: gzip/deflate level of responses for clients accepting it, 0 turns it off
+        :param int compress_min_size: smallest response body compressed, in bytes
+        :param bool etags: ETags on get responses from the updated column and 304 for conditional requests
+        :param bool filter_etags: the same on filter responses, every filter request then pays a max(updated), count(*)
+                                  probe over its whole filter, conditional or not, so it is off by default
+        """
         super(CRUDHTTPService, self).__init__(name, version, host, port)
         self._table_name = table_name
-        self._model = CRUDModel(table=table_name, json_fields=json_fields)
+        self._metrics = metrics
+        self._compress_level = compress_level
+        self._compress_min_size = compress_min_size
+        self._etags = etags
+        self._filter_etags = filter_etags
+        self._model = CRUDModel(table=table_name, json_fields=json_fields, cache=cache, invalidator=invalidator,
+                                coalesce=coalesce, metrics=metrics, slow_log=slow_log)
         self._state_key = state_key
         self._create_schema = create_schema
         self._update_schema = update_schema
@@ -262,6 +1059,17 @@ class CRUDHTTPService:
         self._enable_create()
         self._enable_update()
 
+    def _enable_export(self):
+        path = '/all/export/'
+        if self._base_uri:
+            path = self._base_uri + 's/export/'
+        func = get(path=path)
+        self.__class__.export_records = func(self.export_records)
+
+    def _enable_metrics(self, path='/metrics/'):
+        func = get(path=path)
+        self.__class__.export_metrics = func(self.export_metrics)
+
     def _enable_filter(self):
         path = '/all/'
         if self._base_uri:
@@ -285,33 +1093,117 @@ class CRUDHTTPService:
         func = delete(path=self._base_uri + '/{id}/')
         self.__class__.delete_record = func(self.delete_record)
 
+    async def export_metrics(self, service, request, *args, **kwargs):
+        """
+        metrics in the prometheus text format
+        """
+        body = self._metrics.render() if self._metrics is not None else ''
+        return Response(body=body.encode('utf-8'), headers={'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+    @handler_timer
+    @compressed
     async def filter_record(self, service, request, *args, **kwargs):
         try:
             params = extract_request_params(dict(request.GET))
             if self._state_key and request._state and request._state['user_subs'].get(self._state_key):
                 params['filter'][self._state_key] = request._state['user_subs'][self._state_key]
 
-            results = await self._model.filter(limit=params['limit'],
-                                               offset=params['offset'],
-                                               order_by=params['order_by'],
-                                               **params['filter'])
-            return json_response(results)
-        except RequestKeyError as e:
+            headers = dict()
+            if self._filter_etags:
+                fresh = await self._model.freshness(**params['filter'])
+                # a hard delete can leave max(updated) as it is, only the etag (with the count) covers it
+                headers, not_modified = self._conditional(request, fresh, params, last_modified=False)
+                if not_modified:
+                    return Response(status=304, headers=headers)
+
+            if 'cursor' in params:
+                page = await self._model.paginate(limit=params.get('limit', 15),
+                                                  order_by=params.get('order_by', 'created desc'),
+                                                  cursor=params['cursor'],
+                                                  fields=params.get('fields'),
+                                                  **params['filter'])
+                response = paginated_json_response(request, **page)
+            else:
+                results = await self._model.filter(limit=params['limit'],
+                                                   offset=params['offset'],
+                                                   order_by=params['order_by'],
+                                                   fields=params.get('fields'),
+                                                   raw=True,
+                                                   **params['filter'])
+                response = json_response(results, encoder=self._model.encode)
+            response.headers.update(headers)
+            return response
+        except (RequestKeyError, InvalidCursor, InvalidFields) as e:
             return json_response({'error': str(e)}, status=400)
 
+    @handler_timer
+    @compressed
     async def get_record(self, service, request, *args, **kwargs):
         id = request.match_info.get('id')
+        fields = request.GET.get('fields')
+        params = {'id': id, 'fields': fields}
         try:
-            result = await self._model.get(id=id)
-            return json_response(result)
+            if self._etags and ('If-None-Match' in request.headers or 'If-Modified-Since' in request.headers):
+                fresh = await self._model.freshness(id=id)
+                if fresh['count']:
+                    headers, not_modified = self._conditional(request, fresh, params)
+                    if not_modified:
+                        return Response(status=304, headers=headers)
+
+            result = await self._model.get(fields=fields.split(',') if fields else None, raw=True, id=id)
+            response = json_response(result, encoder=self._model.encode)
+            if self._etags and 'updated' in result:
+                headers, _ = self._conditional(request, {'updated': result['updated'], 'count': 1}, params)
+                response.headers.update(headers)
+            return response
         except RecordNotFound:
             return json_response({'error': '{}_id {} does not exists'.format(self._table_name, id)}, status=400)
+        except InvalidFields as e:
+            return json_response({'error': str(e)}, status=400)
 
+    def _conditional(self, request, fresh: dict, params: dict, last_modified: bool = True) -> tuple:
+        """
+        validator headers of a response built from records with fresh's newest updated and count, and whether the
+        request already holds that response
+        """
+        updated = fresh['updated']
+        # updated has a resolution of a second, changes made during the current one can not be told apart yet
+        if not isinstance(updated, int) or updated >= int(time()):
+            return {}, False
+
+        tag = crc32(json.dumps(params, sort_keys=True).encode('utf-8'))
+        etag = 'W/"{:x}-{:x}-{:x}"'.format(updated, fresh['count'], tag)
+        headers = {'ETag': etag}
+        if last_modified:
+            headers['Last-Modified'] = formatdate(updated, usegmt=True)
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return headers, '*' in tags or etag in tags or etag[2:] in tags
+
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if last_modified and if_modified_since:
+            since = parsedate_tz(if_modified_since)
+            return headers, since is not None and updated <= mktime_tz(since)
+        return headers, False
+
+    async def _payload(self, request):
+        values = await request_json(request)
+        if self._metrics is not None and PAYLOAD_SECONDS_KEY in request:
+            self._metrics.observe('decode_seconds', request.pop(PAYLOAD_SECONDS_KEY), table=self._table_name)
+        return values
+
+    @handler_timer
+    @compressed
     async def create_record(self, service, request, *args, **kwargs):
-        values = await request.json()
+        try:
+            values = await self._payload(request)
+        except ValueError:
+            return json_response({'error': 'invalid json'}, status=400)
 
         if self._create_schema:
-            v = TrellioValidator(self._create_schema, allow_unknown=self._allow_unknown)
+            v = get_validator(self._create_schema, allow_unknown=self._allow_unknown)
             if not v.validate(values):
                 return json_response({'error': v.errors}, status=400)
 
@@ -327,11 +1219,16 @@ class CRUDHTTPService:
         except UndefinedColumnError as e:
             return json_response({'error': str(e)}, status=400)
 
+    @handler_timer
+    @compressed
     async def update_record(self, service, request, *args, **kwargs):
-        values = await request.json()
+        try:
+            values = await self._payload(request)
+        except ValueError:
+            return json_response({'error': 'invalid json'}, status=400)
 
         if self._update_schema:
-            v = TrellioValidator(self._update_schema, allow_unknown=self._allow_unknown)
+            v = get_validator(self._update_schema, allow_unknown=self._allow_unknown)
             if not v.validate(values):
                 return json_response({'error': v.errors}, status=400)
 
@@ -351,22 +1248,70 @@ class CRUDHTTPService:
         except UndefinedColumnError as e:
             return json_response({'error': str(e)}, status=400)
 
+    @handler_timer
+    @compressed
     async def delete_record(self, service, request, *args, **kwargs):
         return json_response(await self._model.delete(id=request.match_info.get('id')))
 
+    @handler_timer
+    async def export_records(self, service, request, *args, **kwargs):
+        """
+        stream every matching record as ndjson (default), csv or a json array, ?format= picks one
+        """
+        query = dict(request.GET)
+        format = query.pop('format', 'ndjson')
+        if format not in EXPORT_CONTENT_TYPES:
+            return json_response({'error': 'format should be one of {}'.format(', '.join(EXPORT_CONTENT_TYPES))},
+                                 status=400)
+        try:
+            params = extract_request_params(query)
+        except RequestKeyError as e:
+            return json_response({'error': str(e)}, status=400)
+
+        if self._state_key and request._state and request._state['user_subs'].get(self._state_key):
+            params['filter'][self._state_key] = request._state['user_subs'][self._state_key]
+
+        batches = self._model.stream(order_by=params.get('order_by', 'created desc'), fields=params.get('fields'),
+                                     **params['filter'])
+        async with batches:
+            try:
+                records = await batches.__anext__()
+            except StopAsyncIteration:
+                records = []
+            except (UndefinedColumnError, InvalidFields) as e:
+                return json_response({'error': str(e)}, status=400)
+
+            response = StreamResponse(headers={'Content-Type': EXPORT_CONTENT_TYPES[format]})
+            await response.prepare(request)
+
+            encoder = ExportEncoder(format)
+            response.write(encoder.encode(records))
+            await response.drain()
+            async for records in batches:
+                response.write(encoder.encode(records))
+                await response.drain()
+            response.write(encoder.close())
+
+        await response.write_eof()
+        return response
+
 
 class CRUDTCPService:
     def __init__(self, name, version, host, port, table_name='', required_params=(), create_schema=None,
-                 update_schema=None, allow_unknown=False, json_fields=()):
+                 update_schema=None, allow_unknown=False, json_fields=(), cache=None,
+                 invalidator=None, coalesce=(), metrics=None, slow_log=None):
         super(CRUDTCPService, self).__init__(name, version, host, port)
         self._table_name = table_name
-        self._model = CRUDModel(table=table_name, json_fields=json_fields)
+        self._metrics = metrics
+        self._model = CRUDModel(table=table_name, json_fields=json_fields, cache=cache, invalidator=invalidator,
+                                coalesce=coalesce, metrics=metrics, slow_log=slow_log)
         self._required_params = required_params
         self._create_schema = create_schema
         self._update_schema = update_schema
         self._allow_unknown = allow_unknown
 
     @api
+    @handler_timer
     async def filter_record(self, params):
         try:
             if not params.get('filter'):
@@ -374,26 +1319,39 @@ class CRUDTCPService:
             return await self._model.filter(limit=params.get('limit'),
                                             offset=params.get('offset'),
                                             order_by=params.get('order_by'),
+                                            fields=params.get('fields'),
                                             **params.get('filter'))
 
-        except RequestKeyError as e:
+        except (RequestKeyError, InvalidFields) as e:
             return {'error': str(e)}
 
     @api
-    async def get_record(self, id):
+    @handler_timer
+    async def get_record(self, id, fields=None):
         try:
-            return await self._model.get(id=id)
+            return await self._model.get(fields=fields, id=id)
         except RecordNotFound:
             return {'error': '{}_id {} does not exists'.format(self._table_name, id)}
+        except InvalidFields as e:
+            return {'error': str(e)}
+
+    @api
+    @handler_timer
+    async def get_records(self, ids, fields=None):
+        try:
+            return await self._model.get_many(ids, fields=fields)
+        except InvalidFields as e:
+            return {'error': str(e)}
 
     @api
+    @handler_timer
     async def create_record(self, values):
         missing_params = list(filter(lambda x: x not in values.keys(), self._required_params))
         if missing_params:
             return {'error': 'required params - {} not found'.format(', '.join(missing_params))}
 
         if self._create_schema:
-            v = TrellioValidator(self._create_schema, allow_unknown=self._allow_unknown)
+            v = get_validator(self._create_schema, allow_unknown=self._allow_unknown)
             if not v.validate(values):
                 return {'error': v.errors}
 
@@ -405,9 +1363,34 @@ class CRUDTCPService:
             return {'error': str(e)}
 
     @api
+    @handler_timer
+    async def bulk_create_records(self, values, returning=False):
+        errors = dict()
+        for index, row in enumerate(values):
+            missing_params = list(filter(lambda x: x not in row.keys(), self._required_params))
+            if missing_params:
+                errors[index] = 'required params - {} not found'.format(', '.join(missing_params))
+                continue
+
+            if self._create_schema:
+                v = get_validator(self._create_schema, allow_unknown=self._allow_unknown)
+                if not v.validate(row):
+                    errors[index] = v.errors
+        if errors:
+            return {'error': errors}
+
+        try:
+            return await self._model.bulk_create(values, returning=returning)
+        except UniqueViolationError:
+            return {'error': 'duplicate record'}
+        except UndefinedColumnError as e:
+            return {'error': str(e)}
+
+    @api
+    @handler_timer
     async def update_record(self, id, params):
         if self._update_schema:
-            v = TrellioValidator(self._update_schema, allow_unknown=self._allow_unknown)
+            v = get_validator(self._update_schema, allow_unknown=self._allow_unknown)
             if not v.validate(params):
                 return {'error': v.errors}
 
@@ -421,5 +1404,6 @@ class CRUDTCPService:
             return {'error': str(e)}
 
     @api
+    @handler_timer
     async def delete_record(self, id):
         return await self._model.delete(id=id)
@@ -0,0 +1,220 @@
+from asyncio import Lock
+from collections import OrderedDict
+from time import monotonic
+
+from trelliopg import get_db_adapter
+
+try:
+    import ujson as json
+except:
+    import json
+
+
+class RecordCache:
+    """
+    In process LRU cache of serialized records with an optional ttl (seconds), entries are keyed by table and where
+    clause and indexed by record id so writes can drop every entry holding a changed row.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, record)
+        self._ids = dict()  # (table, id) -> set of keys
+        self._generations = dict()  # table -> number of invalidations
+        self._clears = 0
+
+    @staticmethod
+    def make_key(table: str, where: dict) -> tuple:
+        return (table,) + tuple(sorted((key, str(value)) for key, value in where.items()))
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._entries)}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, record = entry
+        if expires_at is not None and expires_at < monotonic():
+            self._remove(key)
+            self.evictions += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return record
+
+    def generation(self, table: str) -> tuple:
+        """
+        changes whenever entries of the table are invalidated, taken before a query and given to set
+        """
+        return self._clears, self._generations.get(table, 0)
+
+    def set(self, key, record: dict, generation: tuple = None):
+        """
+        :param tuple generation: generation of the table when the record was read, the record is not cached when the
+                                 table was invalidated since then as it may predate the write
+        """
+        if generation is not None and generation != self.generation(key[0]):
+            return
+        if key in self._entries:
+            self._remove(key)
+
+        expires_at = monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (expires_at, record)
+        self._ids.setdefault((key[0], str(record.get('id'))), set()).add(key)
+
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, table: str, where: dict = None, records=()):
+        """
+        drop the entries of a table holding any of the given records or matching where, every entry of the table is
+        dropped when neither can pin down the affected rows. An inserted or updated record can also become the answer
+        to an entry cached by another where clause, so the entries whose where clause the records match are dropped too
+        """
+        self._generations[table] = self._generations.get(table, 0) + 1
+        ids = {str(record['id']) for record in records if record.get('id')}
+        if where and 'id' in where:
+            ids.add(str(where['id']))
+
+        for id in ids:
+            for key in list(self._ids.get((table, id), ())):
+                self._remove(key)
+
+        if records:
+            for key in list(self._entries):
+                by_id = len(key) == 2 and key[1][0] == 'id'
+                if key[0] == table and not by_id and any(self._matches(key, record) for record in records):
+                    self._remove(key)
+
+        if ids or (where is None and records):
+            return
+
+        if where and not any('__' in column for column in where):
+            matches = lambda record: all(str(record.get(k)) == str(v) for k, v in where.items())
+        else:
+            matches = lambda record: True
+
+        for key, (_, record) in list(self._entries.items()):
+            if key[0] == table and matches(record):
+                self._remove(key)
+
+    def clear(self):
+        self._clears += 1
+        self._entries.clear()
+        self._ids.clear()
+
+    @staticmethod
+    def _matches(key, record: dict) -> bool:
+        """
+        whether the record may answer the where clause of key, columns the record does not hold (ids only records
+        from a notification) and lookups other than equality count as a match
+        """
+        return all('__' in column or column not in record or str(record[column]) == value
+                   for column, value in key[1:])
+
+    def _remove(self, key):
+        _, record = self._entries.pop(key)
+        id_key = (key[0], str(record.get('id')))
+        keys = self._ids.get(id_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._ids[id_key]
+
+
+class CacheInvalidator:
+    """
+    Publishes table changes with NOTIFY and evicts them from the registered caches of every node listening on the
+    channel. The listener holds one connection of the pool for as long as it runs.
+    """
+    MAX_PAYLOAD = 7999  # postgres rejects notify payloads of 8000 bytes or more
+
+    def __init__(self, channel: str = 'trelliolibs_cache'):
+        self.channel = channel
+        self.received = 0
+        self._db = get_db_adapter()
+        self._caches = dict()  # table -> list of caches
+        self._con = None
+        self._lock = Lock()
+
+    def register(self, table: str, cache: RecordCache):
+        caches = self._caches.setdefault(table, [])
+        if cache not in caches:
+            caches.append(cache)
+
+    async def listen(self):
+        if self._con is not None and not self._con.is_closed():
+            return
+
+        async with self._lock:
+            if self._con is not None and not self._con.is_closed():
+                return
+
+            if self._con is not None:
+                # notifications sent while the connection was down are lost
+                for caches in self._caches.values():
+                    for cache in caches:
+                        cache.clear()
+                con, self._con = self._con, None
+                pool = await self._db.get_pool()
+                try:
+                    await pool.release(con)
+                except Exception:
+                    # the pool may refuse a connection that was closed under it, it is replaced either way
+                    pass
+
+            pool = await self._db.get_pool()
+            con = await pool.acquire()
+            await con.add_listener(self.channel, self._on_notify)
+            self._con = con
+
+    async def close(self):
+        if self._con is not None:
+            con, self._con = self._con, None
+            if not con.is_closed():
+                await con.remove_listener(self.channel, self._on_notify)
+            pool = await self._db.get_pool()
+            await pool.release(con)
+
+    async def publish(self, table: str, where: dict = None, records=(), con=None):
+        """
+        :param con: connection of the write, inside its transaction the notification is only delivered on commit
+        """
+        message = {'table': table, 'ids': [str(record['id']) for record in records if record.get('id')]}
+        if where is not None:
+            message['where'] = {key: str(value) for key, value in where.items()}
+
+        payload = json.dumps(message)
+        if len(payload.encode('utf-8')) > self.MAX_PAYLOAD:
+            payload = json.dumps({'table': table, 'ids': []})
+
+        if con is not None:
+            await con.execute("""select pg_notify($1, $2)""", self.channel, payload)
+            return
+
+        pool = await self._db.get_pool()
+        async with pool.acquire() as con:
+            await con.execute("""select pg_notify($1, $2)""", self.channel, payload)
+
+    def _on_notify(self, con, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+
+        self.received += 1
+        table = message.get('table')
+        records = [{'id': id} for id in message.get('ids', ())]
+        for cache in self._caches.get(table, ()):
+            cache.invalidate(table, where=message.get('where'), records=records)
@@ -1,11 +1,11 @@
+from collections.abc import Mapping, Sequence
 from functools import wraps
-from json import JSONDecodeError
 from uuid import UUID
 
 from cerberus import Validator
 from trellio import HTTPService, TCPService, HTTPView, TCPView
 
-from .helpers import json_response
+from .helpers import json_response, request_json
 
 
 class TrellioValidator(Validator):
@@ -18,17 +18,126 @@ class TrellioValidator(Validator):
         return True
 
 
+FAST_TYPES = {
+    'string': lambda value: isinstance(value, str),
+    'integer': lambda value: isinstance(value, int),
+    'float': lambda value: isinstance(value, (float, int)),
+    'number': lambda value: isinstance(value, (float, int)) and not isinstance(value, bool),
+    'boolean': lambda value: isinstance(value, bool),
+    'dict': lambda value: isinstance(value, Mapping),
+    'list': lambda value: isinstance(value, Sequence) and not isinstance(value, str),
+}
+FAST_RULES = {'type', 'required', 'nullable'}
+
+
+def _is_uuid(value):
+    try:
+        UUID(value, version=4)
+    except ValueError:
+        return False
+    return True
+
+
+class FastValidator:
+    """
+    Plain python checks for schemas made only of type, required and nullable rules, giving the errors cerberus
+    gives. Documents it can not judge, such as a uuid field holding something else than a string, are passed to the
+    cerberus validator.
+    """
+
+    def __init__(self, schema: dict, allow_unknown: bool = False):
+        self.allow_unknown = allow_unknown
+        self.errors = dict()
+        self._validator = TrellioValidator(schema, allow_unknown=allow_unknown)
+        self._fields = dict()  # field -> (required, nullable, type, check)
+        for field, rules in schema.items():
+            type = rules.get('type')
+            check = _is_uuid if type == 'uuid' else FAST_TYPES.get(type)
+            self._fields[field] = (rules.get('required', False), rules.get('nullable', False), type, check)
+
+    @staticmethod
+    def supports(schema: dict) -> bool:
+        for rules in schema.values():
+            if not isinstance(rules, dict) or set(rules) - FAST_RULES:
+                return False
+            type = rules.get('type')
+            if type is None:
+                continue
+            # cerberus also takes a list of types, left to it like any other rule
+            if not isinstance(type, str) or (type != 'uuid' and type not in FAST_TYPES):
+                return False
+        return True
+
+    def validate(self, document) -> bool:
+        if not isinstance(document, dict):
+            return self._fallback(document)
+
+        errors = dict()
+        for field, (required, nullable, type, check) in self._fields.items():
+            if field not in document:
+                if required:
+                    errors[field] = ['required field']
+                continue
+
+            value = document[field]
+            if value is None:
+                if not nullable:
+                    errors[field] = ['null value not allowed']
+                continue
+            if check is None:
+                continue
+            if type == 'uuid' and not isinstance(value, str):
+                return self._fallback(document)
+            if not check(value):
+                errors[field] = ['must be of {} type'.format(type)]
+
+        if not self.allow_unknown:
+            for field in document:
+                if field not in self._fields:
+                    errors[field] = ['unknown field']
+
+        self.errors = errors
+        return not errors
+
+    def _fallback(self, document) -> bool:
+        valid = self._validator.validate(document)
+        self.errors = self._validator.errors
+        return valid
+
+
+_validators = dict()  # (id(schema), allow_unknown) -> (schema, validator)
+
+
+def get_validator(schema: dict, allow_unknown: bool = False):
+    """
+    validator built once per schema object and reused, a FastValidator when the schema allows it. validate and the
+    read of errors run without awaiting in between, so requests sharing a validator do not see each other's errors
+    """
+    key = (id(schema), allow_unknown)
+    cached = _validators.get(key)
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+
+    if FastValidator.supports(schema):
+        validator = FastValidator(schema, allow_unknown=allow_unknown)
+    else:
+        validator = TrellioValidator(schema, allow_unknown=allow_unknown)
+    _validators[key] = (schema, validator)
+    return validator
+
+
 def validate_schema(schema=None, allow_unknown=False):
     def decorator(func):
+        v = get_validator(schema, allow_unknown=allow_unknown) if schema else None
+
         @wraps(func)
         async def wrapper(self, *args, **kwargs):
             if schema:
-                v = TrellioValidator(schema, allow_unknown=allow_unknown)
                 if isinstance(self, HTTPService) or isinstance(self, HTTPView):
                     request = args[0]
                     try:
-                        payload = await request.json()
-                    except JSONDecodeError:
+                        payload = await request_json(request)
+                    except ValueError:
                         data = await request.text()
                         return json_response({'error': 'invalid json', 'data': data}, status=400)
                     if not v.validate(payload):
@@ -50,8 +159,8 @@ def required_params(*params):
             if isinstance(self, HTTPService) or isinstance(self, HTTPView):
                 request = args[0]
                 try:
-                    payload = await request.json()
-                except JSONDecodeError:
+                    payload = await request_json(request)
+                except ValueError:
                     data = await request.text()
                     return json_response({'error': 'invalid json', 'data': data}, status=400)
                 missing_params = list(filter(lambda x: x not in payload.keys(), params))
@@ -1,4 +1,12 @@
 import collections
+import csv
+import gzip
+import io
+import zlib
+from asyncio import get_event_loop
+from collections import OrderedDict
+from time import perf_counter
+from urllib.parse import urlencode
 from uuid import UUID
 
 from asyncpg.exceptions import DuplicateTableError
@@ -11,12 +19,39 @@ except:
     import json
 
 
-def json_response(data, status=200):
-    return Response(content_type='application/json', body=json.dumps(data).encode('utf-8'), status=status)
+PAYLOAD_KEY = 'trelliolibs.payload'
+PAYLOAD_SECONDS_KEY = 'trelliolibs.payload_seconds'
+
+
+async def request_json(request: Request):
+    """
+    json body of a request, decoded once and kept on the request for the decorators and handlers reading it after,
+    with the decode time under PAYLOAD_SECONDS_KEY
+
+    :raises ValueError: body is not valid json
+    """
+    if PAYLOAD_KEY in request:
+        return request[PAYLOAD_KEY]
+
+    body = await request.read()
+    start = perf_counter()
+    payload = json.loads(body.decode(request.charset or 'utf-8'))
+    request[PAYLOAD_SECONDS_KEY] = perf_counter() - start
+    request[PAYLOAD_KEY] = payload
+    return payload
+
+
+def json_response(data, status=200, encoder=None):
+    """
+    :param encoder: encodes data to bytes, such as a RecordEncoder for asyncpg records
+    """
+    body = encoder(data) if encoder is not None else json.dumps(data).encode('utf-8')
+    return Response(content_type='application/json', body=body, status=status)
 
 
 def paginated_json_response(request: Request, records: list = (), limit=10, prev_offset=None, next_offset=None,
-                            last_offset=None, total_records=None, total_pages=None) -> Response:
+                            last_offset=None, total_records=None, total_pages=None, next_cursor=None,
+                            prev_cursor=None, encoder=None) -> Response:
     if request.headers.get('X-Original-URI'):
         path = request.headers['X-Original-URI'].split('?')[0]
         base_url = '{}://{}/{}/'.format(request.scheme, request.host.strip('/'), path.strip('/'))
@@ -27,9 +62,25 @@ def paginated_json_response(request: Request, records: list = (), limit=10, prev
 
     links = []
 
-    first_url = url + '&offset={}'.format(0)
+    if next_cursor or prev_cursor:
+        # a cursor only holds the position, the order and the filters of the page come from the other parameters
+        params = urlencode([(key, value) for key, value in request.GET.items()
+                            if key not in ('limit', 'offset', 'cursor')])
+        if params:
+            url += '&' + params
+        first_url = url + '&cursor='
+    else:
+        first_url = url + '&offset={}'.format(0)
     links.append('<{}>; rel="{}"'.format(first_url, 'first'))
 
+    if next_cursor:
+        next_url = url + '&cursor={}'.format(next_cursor)
+        links.append('<{}>; rel="{}"'.format(next_url, 'next'))
+
+    if prev_cursor:
+        prev_url = url + '&cursor={}'.format(prev_cursor)
+        links.append('<{}>; rel="{}"'.format(prev_url, 'prev'))
+
     if next_offset:
         next_url = url + '&offset={}'.format(next_offset)
         links.append('<{}>; rel="{}"'.format(next_url, 'next'))
@@ -50,8 +101,117 @@ def paginated_json_response(request: Request, records: list = (), limit=10, prev
 
     headers = {'Link': ', '.join(links)} if links else {}
     headers['Access-Control-Expose-Headers'] = 'Link'
-    return Response(content_type='application/json', body=json.dumps(records).encode('utf-8'), status=200,
-                    headers=headers)
+    body = encoder(records) if encoder is not None else json.dumps(records).encode('utf-8')
+    return Response(content_type='application/json', body=body, status=200, headers=headers)
+
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_EXECUTOR_SIZE = 256 * 1024
+COMPRESSORS = OrderedDict([('gzip', gzip.compress), ('deflate', zlib.compress)])
+
+
+def accepted_encoding(accept_encoding: str):
+    """
+    the compression to use for an Accept-Encoding header, gzip or deflate by their q values, None if neither
+    """
+    if not accept_encoding:
+        return None
+
+    weights = dict()
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+
+    default = weights.get('*', 0.0)
+    encodings = [(weights.get(coding, default), coding) for coding in COMPRESSORS]
+    q, coding = max(encodings, key=lambda encoding: encoding[0])
+    return coding if q > 0 else None
+
+
+async def compress_response(request: Request, response: Response, level: int = 6,
+                            min_size: int = COMPRESS_MIN_SIZE, executor_size: int = COMPRESS_EXECUTOR_SIZE,
+                            executor=None) -> Response:
+    """
+    compress the body of response with the encoding the request accepts, bodies of executor_size bytes or more are
+    compressed in executor (the loop default one when None) so they do not hold the event loop
+    """
+    body = getattr(response, 'body', None)
+    if not isinstance(body, bytes) or len(body) < min_size or 'Content-Encoding' in response.headers:
+        return response
+
+    coding = accepted_encoding(request.headers.get('Accept-Encoding'))
+    if coding is None:
+        return response
+
+    compress = COMPRESSORS[coding]
+    if len(body) >= executor_size:
+        body = await get_event_loop().run_in_executor(executor, compress, body, level)
+    else:
+        body = compress(body, level)
+
+    response.body = body
+    response.headers['Content-Encoding'] = coding
+    vary = response.headers.get('Vary')
+    if not vary:
+        response.headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        response.headers['Vary'] = vary + ', Accept-Encoding'
+    return response
+
+
+EXPORT_CONTENT_TYPES = OrderedDict([('ndjson', 'application/x-ndjson'), ('csv', 'text/csv'),
+                                    ('json', 'application/json')])
+
+
+class ExportEncoder:
+    """
+    Encodes successive batches of records to bytes for a streamed export, as newline delimited json, csv with a
+    header taken from the first record or a single json array.
+    """
+
+    def __init__(self, format: str = 'ndjson'):
+        self.format = format
+        self._started = False
+        self._buffer = io.StringIO()
+        self._writer = None
+
+    def encode(self, records: list) -> bytes:
+        if self.format == 'ndjson':
+            return ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+        if self.format == 'json':
+            if not records:
+                return b''
+            chunk = (',' if self._started else '[') + ','.join(json.dumps(record) for record in records)
+            self._started = True
+            return chunk.encode('utf-8')
+
+        if not records:
+            return b''
+        if self._writer is None:
+            self._writer = csv.DictWriter(self._buffer, fieldnames=list(records[0].keys()), extrasaction='ignore')
+            self._writer.writeheader()
+        for record in records:
+            self._writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                                   for key, value in record.items()})
+        chunk = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return chunk.encode('utf-8')
+
+    def close(self) -> bytes:
+        if self.format == 'json':
+            return b']' if self._started else b'[]'
+        return b''
 
 
 def json_file_to_dict(_file: str) -> dict:
@@ -86,6 +246,151 @@ def json_serializer(data, fields=()):
     return data
 
 
+def _none_to_empty(value):
+    return '' if value is None else value
+
+
+def _uuid_to_str(value):
+    return '' if value is None else str(value)
+
+
+def _any_to_str(value):
+    if isinstance(value, UUID):
+        return str(value)
+    return '' if value is None else value
+
+
+def _json_loads(value):
+    return json.loads(value) if value else value
+
+
+class RowSerializer:
+    """
+    Converts records to dicts the way uuid_serializer followed by json_serializer does, but the conversion of each
+    column is picked once per result shape from the column types, so only uuid, json and nullable columns are touched.
+    Columns of unknown type (expressions, other tables) keep the per value checks.
+    """
+
+    def __init__(self, types: dict, not_null=(), json_fields=(), maxsize: int = 256):
+        """
+        :param dict types: column name to sql type
+        :param not_null: columns that never hold null
+        """
+        self.types = types
+        self.not_null = set(not_null)
+        self.json_fields = set(json_fields)
+        self.maxsize = maxsize
+        self._shapes = dict()
+
+    def __call__(self, recs):
+        if not isinstance(recs, list):
+            return self._row(tuple(recs.keys()))(recs)
+        if not recs:
+            return []
+        row = self._row(tuple(recs[0].keys()))
+        return [row(rec) for rec in recs]
+
+    def _row(self, shape):
+        row = self._shapes.get(shape)
+        if row is None:
+            if len(self._shapes) >= self.maxsize:
+                self._shapes.clear()
+            row = self._shapes[shape] = self._compile(shape)
+        return row
+
+    def _compile(self, shape):
+        conversions = []
+        for name in OrderedDict.fromkeys(shape):
+            steps = [step for step in (self._value_step(name), _json_loads if name in self.json_fields else None)
+                     if step is not None]
+            if len(steps) == 1:
+                conversions.append((name, steps[0]))
+            elif steps:
+                conversions.append((name, lambda value, first=steps[0], second=steps[1]: second(first(value))))
+
+        if not conversions:
+            return dict
+
+        def row(record):
+            data = dict(record)
+            for name, convert in conversions:
+                data[name] = convert(data[name])
+            return data
+
+        return row
+
+    def _value_step(self, name):
+        type = self.types.get(name)
+        if type is None:
+            return _any_to_str
+        if type == 'uuid':
+            return str if name in self.not_null else _uuid_to_str
+        if name in self.not_null:
+            return None
+        return _none_to_empty
+
+
+INTEGER_TYPES = {'smallint', 'integer', 'bigint'}
+TEMPORAL_TYPES = {'date', 'timestamp without time zone', 'timestamp with time zone', 'time without time zone',
+                  'time with time zone'}
+
+
+class RecordEncoder(RowSerializer):
+    """
+    Encodes records straight to json bytes, the same document json.dumps gives for the records serialized by
+    RowSerializer, without building a dict per row. json and jsonb fields are copied as the text postgres sends,
+    dates and times are written in iso format, numerics as json numbers with all of their digits. Dicts, as returned
+    from a cache, go through json.dumps.
+    """
+
+    def __call__(self, recs) -> bytes:
+        if not isinstance(recs, list):
+            if isinstance(recs, dict):
+                return json.dumps(recs).encode('utf-8')
+            return self._row(tuple(recs.keys()))(recs).encode('utf-8')
+        if not recs or isinstance(recs[0], dict):
+            return json.dumps(recs).encode('utf-8')
+        row = self._row(tuple(recs[0].keys()))
+        return ('[' + ','.join([row(rec) for rec in recs]) + ']').encode('utf-8')
+
+    def _compile(self, shape):
+        last = {name: index for index, name in enumerate(shape)}
+        columns = [(index, json.dumps(name) + ':', self._encoder(name)) for name, index in last.items()]
+
+        def row(record):
+            return '{' + ','.join([key + encode(record[index]) for index, key, encode in columns]) + '}'
+
+        return row
+
+    def _encoder(self, name):
+        type = self.types.get(name)
+        nullable = name not in self.not_null
+
+        if name in self.json_fields and type in ('json', 'jsonb'):
+            encode = lambda value: value
+        elif name in self.json_fields:
+            return lambda value: json.dumps(_json_loads(_none_to_empty(value)))
+        elif type == 'uuid':
+            encode = lambda value: '"' + str(value) + '"'
+        elif type == 'boolean':
+            encode = lambda value: 'true' if value else 'false'
+        elif type in INTEGER_TYPES:
+            encode = str
+        elif type == 'numeric':
+            # json has no form for nan, it is written as a string
+            encode = lambda value: str(value) if value.is_finite() else '"' + str(value) + '"'
+        elif type in TEMPORAL_TYPES:
+            encode = lambda value: '"' + value.isoformat() + '"'
+        elif type is None:
+            return lambda value: json.dumps(_any_to_str(value))
+        else:
+            encode = json.dumps
+
+        if not nullable:
+            return encode
+        return lambda value: '""' if value is None else encode(value)
+
+
 class RecordHelper:
     @staticmethod
     def record_to_dict(recs, normalize=None):
@@ -0,0 +1,120 @@
+from asyncio import ensure_future, gather, get_event_loop, shield
+from collections import OrderedDict
+from functools import wraps
+
+
+def _copy(result):
+    # records come as dicts, in a list, or in the list of a dict like the pages of paginate
+    if isinstance(result, dict):
+        return dict((key, _copy(value) if isinstance(value, list) else value) for key, value in result.items())
+    if isinstance(result, list):
+        return [_copy(item) if isinstance(item, dict) else item for item in result]
+    return result
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time, callers asking for a key already in flight wait for the same result instead of
+    running the call again. When a result is shared every caller gets its own copy of the records.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = dict()  # key -> [task, followers]
+
+    @property
+    def stats(self) -> dict:
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._flights)}
+
+    async def do(self, key, call):
+        """
+        :param call: no argument callable returning the coroutine to run
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            flight[1] += 1
+            return _copy(await shield(flight[0]))
+
+        self.calls += 1
+        task = ensure_future(call())
+        flight = [task, 0]
+        self._flights[key] = flight
+        # the key is released as soon as the call ends, a caller arriving after that runs a fresh query
+        task.add_done_callback(lambda _: self._flights.pop(key, None))
+
+        # shielded so a cancelled caller does not cancel the query for everyone waiting on it
+        result = await shield(task)
+        return _copy(result) if flight[1] else result
+
+
+def coalesce(method):
+    """
+    share concurrent identical calls of a method through the SingleFlight of the same name in instance._flights,
+    methods without one are called as they are
+    """
+    name = method.__name__
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        flight = self._flights.get(name)
+        if flight is None:
+            return await method(self, *args, **kwargs)
+
+        key = (repr(args), repr(sorted(kwargs.items())))
+        return await flight.do(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
+
+
+class BatchLoader:
+    """
+    Collects the keys loaded during one turn of the event loop and loads them with a single load_many call, in
+    batches of at most max_batch keys. load_many gets the distinct keys and returns one value per key, in order. A
+    batch that fails is loaded again key by key.
+    """
+
+    def __init__(self, load_many, max_batch: int = 1000):
+        self.batches = 0
+        self.loads = 0
+        self.retries = 0
+        self._load_many = load_many
+        self._max_batch = max_batch
+        self._pending = OrderedDict()  # key -> futures waiting on it
+
+    def load(self, key):
+        loop = get_event_loop()
+        future = loop.create_future()
+        if not self._pending:
+            loop.call_soon(self._dispatch)
+        self._pending.setdefault(key, []).append(future)
+        self.loads += 1
+        return future
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, OrderedDict()
+        keys = list(pending)
+        for i in range(0, len(keys), self._max_batch):
+            ensure_future(self._load(keys[i:i + self._max_batch], pending))
+
+    async def _load(self, keys, pending):
+        self.batches += 1
+        try:
+            values = await self._load_many(keys)
+        except Exception as e:
+            if len(keys) > 1:
+                # one bad key fails the whole batch, each key is loaded alone so the error stays with its callers
+                self.retries += 1
+                await gather(*[self._load([key], pending) for key in keys])
+                return
+
+            for future in pending[keys[0]]:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, value in zip(keys, values):
+            for future in pending[key]:
+                if not future.done():
+                    future.set_result(value)
@@ -0,0 +1,96 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from time import perf_counter
+
+TIME_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+BYTE_BUCKETS = (128, 1024, 8192, 65536, 524288, 4194304, 33554432)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, bucket i holds the values up to buckets[i] and the last one the rest.
+    """
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self._metrics, self._name, self._labels = metrics, name, labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.observe(self._name, perf_counter() - self._start, **self._labels)
+
+
+class Metrics:
+    """
+    Histograms per name and labels, rendered in the prometheus text format. The ones observed by CRUDModel and the
+    CRUD services are defined up front, more can be added with histogram.
+    """
+
+    def __init__(self, namespace: str = 'trelliolibs'):
+        self.namespace = namespace
+        self._metrics = OrderedDict()  # name -> [help, buckets, {labels: Histogram}]
+        self.histogram('pool_wait_seconds', 'time waiting for a pool connection', TIME_BUCKETS)
+        self.histogram('query_seconds', 'time a pool connection is held for an operation', TIME_BUCKETS)
+        self.histogram('rows', 'records returned by an operation', ROW_BUCKETS)
+        self.histogram('serialize_seconds', 'time converting records for an operation', TIME_BUCKETS)
+        self.histogram('decode_seconds', 'time decoding json request bodies', TIME_BUCKETS)
+        self.histogram('handler_seconds', 'time spent in a service handler', TIME_BUCKETS)
+        self.histogram('response_bytes', 'size of http response bodies', BYTE_BUCKETS)
+
+    def histogram(self, name: str, help: str, buckets: tuple):
+        if name not in self._metrics:
+            self._metrics[name] = [help, tuple(buckets), dict()]
+
+    def observe(self, name: str, value, **labels):
+        help, buckets, histograms = self._metrics[name]
+        key = tuple(sorted(labels.items()))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def timer(self, name: str, **labels) -> Timer:
+        """
+        context manager observing the seconds spent in its block
+        """
+        return Timer(self, name, labels)
+
+    def render(self) -> str:
+        lines = []
+        for name, (help, buckets, histograms) in self._metrics.items():
+            full_name = '{}_{}'.format(self.namespace, name)
+            lines.append('# HELP {} {}'.format(full_name, help))
+            lines.append('# TYPE {} histogram'.format(full_name))
+            for key, histogram in sorted(histograms.items()):
+                labels = ','.join('{}="{}"'.format(label, self._escape(value)) for label, value in key)
+                separator = ',' if labels else ''
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(full_name, labels, separator, bound, cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(full_name, labels, histogram.sum))
+                lines.append('{}_count{{{}}} {}'.format(full_name, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,9 +1,10 @@
-import json
 from pathlib import Path
 
 from aiohttp import MultipartReader, BodyPartReader
 from aiohttp.hdrs import CONTENT_TYPE
 
+from .helpers import request_json
+
 
 async def default_file_handler(file_name, content, save_to='~/media/'):
     path = Path(save_to)
@@ -56,7 +57,7 @@ async def multipart_parser(request, file_handler=default_file_handler):
                 continue
     else:
         try:
-            multipart_data['data'] = await request.json()
-        except json.JSONDecodeError:
+            multipart_data['data'] = await request_json(request)
+        except ValueError:
             pass
     return multipart_data
@@ -0,0 +1,137 @@
+import logging
+import re
+from asyncio import ensure_future
+from random import random
+from time import perf_counter
+
+from trelliopg import get_db_adapter
+
+logger = logging.getLogger(__name__)
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'(?<![\w$])\d+(?:\.\d+)?\b')
+_SPACES = re.compile(r'\s+')
+# statements analyze would have to run with their side effects or wait on the locks of the slow transaction
+_NOT_ANALYZED = re.compile(r'\bfor\s+(?:no\s+key\s+)?(?:update|share|key\s+share)\b|\bpg_advisory|\bpg_notify|\bnextval\b',
+                           re.IGNORECASE)
+
+
+def analyzable(query: str) -> bool:
+    """
+    whether EXPLAIN ANALYZE can run the query again, only plain selects are, writes and locking reads get a plain
+    EXPLAIN
+    """
+    return query.lstrip().lower().startswith('select') and not _NOT_ANALYZED.search(query)
+
+
+def query_shape(query: str) -> str:
+    """
+    query text with its literals replaced by ?, queries differing only in literal values share a shape
+    """
+    return _SPACES.sub(' ', _NUMBERS.sub('?', _STRINGS.sub('?', query))).strip()
+
+
+class SlowQueryLog:
+    """
+    Logs queries slower than threshold (seconds) with their arguments and duration, and aggregates them by shape. A
+    sample of them, explain_rate, is explained on another pool connection and the plan is logged too. Plain selects
+    are run again with EXPLAIN (ANALYZE, BUFFERS) inside a transaction that is rolled back, writes and locking reads
+    are only planned with EXPLAIN.
+    """
+
+    def __init__(self, threshold: float = 0.5, explain_rate: float = 0.1, maxshapes: int = 1000):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.maxshapes = maxshapes
+        self._db = get_db_adapter()
+        self._shapes = dict()  # shape -> {'count', 'total', 'max', 'args', 'plan'}
+
+    async def run(self, method, query: str, *args):
+        """
+        await method(query, *args), a connection method such as fetch or execute, and observe its duration
+        """
+        start = perf_counter()
+        result = await method(query, *args)
+        self.observe(query, args, perf_counter() - start)
+        return result
+
+    def observe(self, query: str, args, duration: float):
+        if duration < self.threshold:
+            return
+
+        logger.warning('slow query (%.3fs): %s %s', duration, query, list(args))
+        shape = query_shape(query)
+        stats = self._shapes.get(shape)
+        if stats is None:
+            if len(self._shapes) >= self.maxshapes:
+                del self._shapes[min(self._shapes, key=lambda key: self._shapes[key]['total'])]
+            stats = self._shapes[shape] = {'count': 0, 'total': 0, 'max': 0, 'args': None, 'plan': None}
+        stats['count'] += 1
+        stats['total'] += duration
+        if duration >= stats['max']:
+            stats['max'] = duration
+            stats['args'] = list(args)
+
+        if self.explain_rate and random() < self.explain_rate and not shape.lower().startswith('explain'):
+            ensure_future(self._explain(shape, query, args))
+
+    def top(self, n: int = 10, by: str = 'total') -> list:
+        """
+        :param str by: total, max or mean duration
+        :return: the n slowest query shapes with their count, total, max and mean durations, arguments of the slowest
+                 run and the last sampled plan
+        """
+        shapes = []
+        for shape, stats in self._shapes.items():
+            entry = dict(stats, query=shape, mean=stats['total'] / stats['count'])
+            shapes.append(entry)
+        return sorted(shapes, key=lambda entry: entry[by], reverse=True)[:n]
+
+    def reset(self):
+        self._shapes.clear()
+
+    async def _explain(self, shape, query, args):
+        try:
+            pool = await self._db.get_pool()
+            async with pool.acquire() as con:
+                transaction = con.transaction()
+                await transaction.start()
+                explain = 'explain (analyze, buffers) ' if analyzable(query) else 'explain '
+                try:
+                    rows = await con.fetch(explain + query, *args)
+                finally:
+                    await transaction.rollback()
+        except Exception:
+            logger.exception('explain of slow query failed: %s', query)
+            return
+
+        plan = '\n'.join(row[0] for row in rows)
+        logger.warning('plan of slow query: %s\n%s', query, plan)
+        if shape in self._shapes:
+            self._shapes[shape]['plan'] = plan
+
+
+class LoggedConnection:
+    """
+    Connection proxy timing fetch, fetchrow, fetchval and execute through a SlowQueryLog, everything else goes to the
+    connection as it is.
+    """
+
+    def __init__(self, con, slow_log: SlowQueryLog):
+        self._con = con
+        self._slow_log = slow_log
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._slow_log.run(lambda *a: self._con.fetch(*a, **kwargs), query, *args)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._slow_log.run(lambda *a: self._con.fetchrow(*a, **kwargs), query, *args)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._slow_log.run(lambda *a: self._con.fetchval(*a, **kwargs), query, *args)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._slow_log.run(lambda *a: self._con.execute(*a, **kwargs), query, *args)
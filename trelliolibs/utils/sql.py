@@ -0,0 +1,184 @@
+from collections import OrderedDict
+
+try:
+    import ujson as json
+except:
+    import json
+
+# postgres takes at most 32767 bind parameters per statement
+MAX_PARAMS = 32767
+
+
+class QueryBuilder:
+    """
+    Builds parameterized sql for a table. The text of a query only depends on its shape (columns, filter keys and
+    operators, ordering, paging) so it is built once per shape, and asyncpg prepares it once per connection through
+    its statement cache. Filter and update values are sent as text and cast to the column type, which keeps the
+    coercion of the quoted literals used before.
+    """
+
+    def __init__(self, table: str, types: dict, maxsize: int = 512):
+        """
+        :param dict types: column name to sql type, filters on unknown columns are left uncast
+        :param int maxsize: number of query shapes to keep, filter keys come from requests so shapes are not bounded
+        """
+        self.table = table
+        self.types = types
+        self.maxsize = maxsize
+        self._queries = OrderedDict()
+
+    def select(self, filter: dict = None, columns: str = '*', order_by: str = None, offset=None, limit=None,
+               seek: tuple = None) -> tuple:
+        """
+        :param tuple seek: (column, operator, nulls, value, id) keyset condition on (column, id), nulls is None for
+                           a not null column or where the query orders them, 'first' or 'last'
+        :return: query and its arguments, paging is applied when offset or limit is given, 'ALL' means no limit
+        """
+        keys = tuple(sorted(filter)) if filter else ()
+        paged = offset is not None or limit is not None
+        seek_shape = seek[:3] + (seek[3] is None,) if seek else None
+        query = self._cached(('select', columns, keys, order_by, paged, seek_shape),
+                             lambda: self._select(columns, keys, order_by, paged, seek_shape))
+
+        args = self.args(keys, filter)
+        if seek:
+            args.extend(self.text(value) for value in seek[3:] if value is not None)
+        if paged:
+            args.append(int(offset or 0))
+            args.append(None if limit is None or str(limit).upper() == 'ALL' else int(limit))
+        return query, args
+
+    def update(self, values: dict, filter: dict) -> tuple:
+        columns = tuple(values)
+        keys = tuple(sorted(filter)) if filter else ()
+        query = self._cached(('update', columns, keys), lambda: self._update(columns, keys))
+        return query, [self.text(values[column]) for column in columns] + self.args(keys, filter)
+
+    def delete(self, filter: dict) -> tuple:
+        keys = tuple(sorted(filter)) if filter else ()
+        query = self._cached(('delete', keys), lambda: """delete from {}{}""".format(self.table, self._where(keys)))
+        return query, self.args(keys, filter)
+
+    def insert(self, columns: tuple, rows: int = 1, on_conflict: str = '', cast: bool = False) -> str:
+        """
+        multi row insert, values are bound row after row
+        :param bool cast: values are bound as text and cast to the column types like in update, see values, otherwise
+                          they are bound as they are
+        """
+        casts = [self._cast(column) for column in columns] if cast else ()
+        return self._cached(('insert', columns, rows, on_conflict, cast),
+                            lambda: """insert into {} ({}) values {}{} returning *""".format(
+                                self.table, ','.join(columns), self._placeholders(len(columns), rows, casts),
+                                on_conflict))
+
+    def update_from_values(self, columns: tuple, rows: int, key: str) -> str:
+        """
+        update joining the table on key with a VALUES list, values are bound as text row after row, see values
+        """
+        return self._cached(('update_from_values', columns, rows, key),
+                            lambda: self._update_from_values(columns, rows, key))
+
+    def values(self, columns: tuple, rows: list) -> list:
+        """
+        arguments of rows for the placeholders cast to the column types, as text
+        """
+        return [self.text(values[column]) for values in rows for column in columns]
+
+    def args(self, keys: tuple, filter: dict) -> list:
+        args = []
+        for key in keys:
+            if self._split(key)[1] == 'in':
+                args.append([self.text(value) for value in filter[key]])
+            else:
+                args.append(self.text(filter[key]))
+        return args
+
+    def _cached(self, shape, build) -> str:
+        query = self._queries.get(shape)
+        if query is None:
+            query = build()
+            self._queries[shape] = query
+            if len(self._queries) > self.maxsize:
+                self._queries.popitem(last=False)
+        return query
+
+    def _select(self, columns, keys, order_by, paged, seek) -> str:
+        query = """select {} from {}""".format(columns, self.table)
+        where = self._where(keys)
+        if seek:
+            where += (' and ' if where else ' where ') + self._seek(seek, len(keys) + 1)
+        query += where
+
+        if order_by:
+            query += ' order by {}'.format(order_by)
+        if paged:
+            start = len(keys) + ((1 if seek[3] else 2) if seek else 0)
+            query += ' offset ${} limit ${}'.format(start + 1, start + 2)
+        return query
+
+    def _seek(self, seek, start) -> str:
+        column, operator, nulls, null_value = seek
+        id = 'id {} ${}{}'.format(operator, start + (0 if null_value else 1), self._cast('id'))
+        if null_value:
+            # past a null row come the null rows after it by id, then the values when nulls are ordered first
+            condition = '{} is null and {}'.format(column, id)
+            return condition if nulls == 'last' else '({} or {} is not null)'.format(condition, column)
+
+        # a row comparison with a null is null, null rows are only reached through the explicit condition
+        condition = '({}, id) {} (${}{}, ${}{})'.format(column, operator, start, self._cast(column), start + 1,
+                                                      self._cast('id'))
+        return condition if nulls != 'last' else '({} or {} is null)'.format(condition, column)
+
+    def _update(self, columns, keys) -> str:
+        values = ','.join('{} = ${}{}'.format(column, i, self._cast(column)) for i, column in enumerate(columns, 1))
+        return """update {} set {}{} returning *""".format(self.table, values, self._where(keys, len(columns) + 1))
+
+    def _update_from_values(self, columns, rows, key) -> str:
+        # values carry no column types of their own, so every placeholder is cast to the type of its column
+        values = self._placeholders(len(columns), rows, [self._cast(column) for column in columns])
+        return """update {table} set {set} from (values {values}) as v ({columns})
+                  where {table}.{key} = v.{key} returning {table}.*""".format(
+            table=self.table, set=','.join('{0} = v.{0}'.format(c) for c in columns if c != key), values=values,
+            columns=','.join(columns), key=key)
+
+    def _where(self, keys, start=1) -> str:
+        conditions = []
+        for i, key in enumerate(keys, start):
+            column, operator = self._split(key)
+            if operator == 'in':
+                conditions.append('{} = any(${}{})'.format(column, i, self._cast(column, array=True)))
+            else:
+                conditions.append('{} {} ${}{}'.format(column, operator, i, self._cast(column)))
+
+        if not conditions:
+            return ''
+        return ' where ' + ' and '.join(conditions)
+
+    def _cast(self, column, array=False) -> str:
+        type = self.types.get(column)
+        if not type:
+            return ''
+        if array:
+            return '::text[]::{}[]'.format(type)
+        return '::text::{}'.format(type)
+
+    @staticmethod
+    def _placeholders(width, rows, casts=()) -> str:
+        casts = [casts[i] if i < len(casts) else '' for i in range(width)]
+        return ','.join('({})'.format(','.join('${}{}'.format(row * width + i + 1, casts[i]) for i in range(width)))
+                        for row in range(rows))
+
+    @staticmethod
+    def _split(key) -> tuple:
+        split_key = key.split('__')
+        if len(split_key) > 1:
+            return split_key[0], split_key[1]
+        return key, '='
+
+    @staticmethod
+    def text(value):
+        if value is None:
+            return None
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return str(value)